@@ -0,0 +1,124 @@
+"""
+Latency of the memory-packing summarizer backends on realistic packs.
+
+Packs are built the way MemoryManager._pack_old_messages builds them ("role:
+content" lines) from the demo answers: romanized-Lebanese packs as they are,
+English packs from a short parent/assistant exchange. Backends that can't run
+here are skipped: openai without OPENAI_API_KEY, bart without transformers.
+Backends are called directly rather than through summarize_text, whose
+truncation fallback would hide a failing backend as a very fast one; failed
+calls are counted and left out of the latencies.
+
+    python bench_summarizers.py                       # every available backend
+    python bench_summarizers.py --backends extractive --runs 200
+"""
+import os
+import time
+import argparse
+import statistics
+
+from dotenv import load_dotenv
+
+load_dotenv()
+os.environ.setdefault("OPENAI_API_KEY", "")  # importing memory_manager must not need a key
+
+from demo_answers import DEMO_RESPONSES
+from memory_manager import SUMMARIZERS
+
+ENGLISH_TURNS = [
+    ("user", "My son is 4 and was just diagnosed with autism. He doesn't talk yet and gets upset when we leave the house."),
+    ("assistant", "It is very common for young autistic children to have delayed speech. <br><li>Use short, simple words "
+                  "and name things he looks at.</li><li>Try picture cards so he can show you what he wants.</li>"
+                  "Speech therapy can help a lot, and earlier is better."),
+    ("user", "What about the meltdowns when we go out? He covers his ears and screams at the supermarket."),
+    ("assistant", "Covering his ears suggests the noise and lights are too much for him. Noise-cancelling headphones, "
+                  "short visits at quiet times and a visual schedule of the trip can make outings easier. "
+                  "Stay calm and move him somewhere quieter when it starts."),
+    ("user", "Should I worry that he lines up his toys all day?"),
+    ("assistant", "Lining up toys is a typical autistic way of playing and is usually calming for him. "
+                  "Join in gently and build on it, for example by counting or naming the colours together."),
+]
+
+
+def lebanese_packs(turns_per_pack: int = 6):
+    pairs = []
+    for question, entry in DEMO_RESPONSES.items():
+        answer = " ".join(seg.get("content", "") for seg in entry.get("answer", []) if seg.get("type") == "text")
+        pairs += [("user", question), ("assistant", answer)]
+    return ["\n".join(f"{role}: {content}" for role, content in pairs[i:i + turns_per_pack])
+            for i in range(0, len(pairs), turns_per_pack)]
+
+
+def english_packs():
+    return ["\n".join(f"{role}: {content}" for role, content in ENGLISH_TURNS)]
+
+
+def available(backend: str) -> str:
+    """Why a backend can't run here, or "" if it can."""
+    if backend == "openai" and not os.getenv("OPENAI_API_KEY"):
+        return "OPENAI_API_KEY not set"
+    if backend == "bart":
+        try:
+            import transformers  # noqa: F401
+        except ImportError:
+            return "transformers not installed"
+    return ""
+
+
+def bench(backend: str, packs, runs: int):
+    summarize = SUMMARIZERS[backend]
+    summarize(packs[0])  # model load / connection set-up is not per-pack cost; an error here stops the backend
+    times, lengths, errors = [], [], []
+    for i in range(runs):
+        pack = packs[i % len(packs)]
+        started = time.perf_counter()
+        try:
+            summary = summarize(pack)
+        except Exception as e:
+            errors.append(e)
+            continue
+        times.append((time.perf_counter() - started) * 1000)
+        lengths.append(len(summary))
+    if not times:
+        raise errors[0]
+    times.sort()
+    return {
+        "ok": len(times),
+        "failed": len(errors),
+        "p50": statistics.median(times),
+        "p95": times[min(len(times) - 1, int(len(times) * 0.95))],
+        "mean": statistics.fmean(times),
+        "chars": statistics.fmean(lengths),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=list(SUMMARIZERS), choices=list(SUMMARIZERS))
+    parser.add_argument("--runs", type=int, default=None, help="summaries per backend and language "
+                        "(default 100 for extractive, 5 for the others)")
+    parser.add_argument("--show", action="store_true", help="print one summary per backend and language")
+    args = parser.parse_args()
+
+    corpora = {"lebanese": lebanese_packs(), "english": english_packs()}
+    print(f"{'backend':<11} {'lang':<9} {'ok':>5} {'failed':>6} {'p50 ms':>9} {'p95 ms':>9} {'mean ms':>9} {'chars':>6}")
+    for backend in args.backends:
+        reason = available(backend)
+        if reason:
+            print(f"{backend:<11} skipped: {reason}")
+            continue
+        runs = args.runs or (100 if backend == "extractive" else 5)
+        for lang, packs in corpora.items():
+            try:
+                r = bench(backend, packs, runs)
+            except Exception as e:
+                print(f"{backend:<11} {lang:<9} failed: {e.__class__.__name__}: {e}")
+                continue
+            print(f"{backend:<11} {lang:<9} {r['ok']:>5} {r['failed']:>6} "
+                  f"{r['p50']:>9.2f} {r['p95']:>9.2f} {r['mean']:>9.2f} {r['chars']:>6.0f}")
+            if args.show:
+                print(f"    {SUMMARIZERS[backend](packs[0])}")
+
+
+if __name__ == "__main__":
+    main()
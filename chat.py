@@ -1,21 +1,55 @@
+from utils.warmup import WARMUP, timed_import  # first, so the startup report measures from process start
 import os, re, json, time, hashlib
 from pathlib import Path
 import streamlit as st
-import chromadb
-from openai import OpenAI
 from dotenv import load_dotenv
-from utils.dialect import detect_leb_chat, normalize_for_embedding
-from demo_answers import DEMO_RESPONSES
-import numpy as np
-from memory_manager import MemoryManager
+
+env_path = Path(__file__).parent / ".env"
+load_dotenv(dotenv_path=env_path, override=True)
+
+# ---------------- Background Warm-up ----------------
+# Heavy imports and one-time setup run off the request path once the login page is up;
+# the code below that needs them waits on (or runs) the task through WARMUP.result().
+def warm_imports():
+    for module in ("numpy", "openai", "chromadb", "demo_answers", "engine", "memory_manager", "utils.images"):
+        timed_import(module)
+
+def warm_engine():
+    from engine import AnswerEngine
+    from utils.answer_cache import read_kb_version
+    engine = AnswerEngine()                         # opens Chroma, loads the demo index
+    engine.lexical_index(read_kb_version())         # BM25 postings
+    return engine
+
+def warm_images():
+    from utils.images import get_image_service
+    images = get_image_service()
+    images.warm()
+    return images
+
+def warm_summarizer():
+    from memory_manager import warm_summarizer
+    warm_summarizer()                               # loads the local model when that backend is configured
+
+WARMUP.add("imports", warm_imports)
+WARMUP.add("engine", warm_engine)
+WARMUP.add("images", warm_images)
+WARMUP.add("summarizer", warm_summarizer)
 
 # ---------------- User Login ----------------
 from user_login import login_page
 
 user_data = login_page()
+WARMUP.mark("login_rendered")
+WARMUP.start()
 if not user_data:
     st.stop()                           # wait until user logs in or registers
 
+from utils.demo_index import demo_fingerprint
+from demo_answers import DEMO_RESPONSES
+from engine import AnswerEngine
+from memory_manager import MemoryManager
+
 # Once logged in:
 user_id = user_data["id"]
 user_name = user_data["name"]
@@ -24,8 +58,12 @@ has_autistic_child = user_data["has_autistic_child"]
 # ---------------- LOGOUT FUNCTIONALITY ----------------
 def logout():
     """Clear session state and force a rerun to go back to login."""
+    # Let any background summarization finish before the memory manager is dropped
+    if "memory_manager" in st.session_state:
+        st.session_state.memory_manager.close()
     # Clear the specific login/user data keys
-    for key in ["user_data", "user_id", "session_id", "history", "greeted", "memory_manager"]:
+    for key in ["user_data", "user_id", "session_id", "history", "greeted", "memory_manager",
+                "history_window", "render_cache", "archive", "archive_cursor"]:
         if key in st.session_state:
             del st.session_state[key]
     st.rerun()
@@ -69,81 +107,50 @@ if st.button("🔴 Log Out", key="logout_button_id"):
 
 
 # ---------------- Env ----------------
-env_path = Path(__file__).parent / ".env"
-load_dotenv(dotenv_path=env_path, override=True)
-
-CHROMA_PATH = Path(os.getenv("CHROMA_PATH", "db"))
-COLLECTION_NAME = os.getenv("COLLECTION_NAME", "autism_bot")
-CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o-mini")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-
-client = OpenAI(api_key=OPENAI_API_KEY)
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "1") == "1"  # render tokens as they arrive
+METRICS_PANEL = os.getenv("METRICS_PANEL", "0") == "1"     # default state of the sidebar debug panel
+HISTORY_PAGE = int(os.getenv("HISTORY_PAGE", "10"))         # messages drawn per rerun / per "show earlier" click
 
 # ---------------- Image Map ----------------
 IMG_TOKEN = re.compile(r"\[\[image:([a-zA-Z0-9_\-]+)\]\]")
-IMAGE_MAP = {}
-IMAGE_MAP_PATH = Path("assets/image_map.json")
-if IMAGE_MAP_PATH.exists():
-    IMAGE_MAP = json.loads(IMAGE_MAP_PATH.read_text(encoding="utf-8"))
 
-def render_images_from_answer(answer_text: str):
+@st.cache_resource
+def get_images():
+    """image_map.json is validated and hashed once per process; derivatives are prebuilt by the warm-up."""
+    return WARMUP.result("images")
+
+IMAGES = get_images()
+
+def show_image(tag: str, width: int = 500):
+    """Render a mapped image from the derivative cache (small WebP bytes, not the source PNG)."""
+    data = IMAGES.get(tag, width)
+    if data is not None:
+        st.image(data, caption=IMAGES.caption(tag), width=width)
+
+def render_images_from_answer(answer_text: str, shown: set = None):
+    """Render [[image:tag]] tokens; tags already in `shown` are skipped (used while streaming)."""
     tags = IMG_TOKEN.findall(answer_text)
     for t in tags:
-        if t in IMAGE_MAP:
-            st.image(IMAGE_MAP[t], caption=t.replace("_", " ").title(), width=500)
-
-# ---------------- Connect to Chroma ----------------
+        if shown is not None:
+            if t in shown:
+                continue
+            shown.add(t)
+        if t in IMAGES:
+            show_image(t)
+
+# ---------------- Answer Engine ----------------
 @st.cache_resource
-def get_collection():
-    chroma_client = chromadb.PersistentClient(path=str(CHROMA_PATH))
-    return chroma_client.get_or_create_collection(name=COLLECTION_NAME)
-
-def compose_context(documents, metadatas, cap=12000) -> str:
-    out, used = [], 0
-    for d, m in zip(documents, metadatas):
-        src = m.get("file", m.get("source", "kb"))
-        seg = f"\n---\nSource: {src}\n---\n{d}"
-        if used + len(seg) > cap:
-            break
-        out.append(seg)
-        used += len(seg)
-    return "\n".join(out)
+def get_engine(fingerprint: str):
+    """Chroma, demo index and BM25 index are loaded once; editing DEMO_RESPONSES picks up a fresh engine."""
+    engine = WARMUP.result("engine")
+    if engine.demo_index.fingerprint != fingerprint:
+        engine = AnswerEngine()
+    return engine
 
 def show_img(path, caption=None, width=500):
     st.image(path, caption=caption, width=width)
 
-collection = get_collection()
-
-# ---------------- Precompute Demo Question Embeddings ----------------
-@st.cache_resource
-def get_demo_embeddings():
-    demo_keys = list(DEMO_RESPONSES.keys())
-    embs = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=demo_keys
-    ).data
-    emb_vectors = [e.embedding for e in embs]
-    return dict(zip(demo_keys, emb_vectors))
-
-DEMO_EMBEDS = get_demo_embeddings()
-
-def find_similar_demo(query: str, threshold: float = 0.88):
-    """Find the most semantically similar demo question using cosine similarity."""
-    q_emb = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=query
-    ).data[0].embedding
-
-    def cosine_sim(a, b):
-        a, b = np.array(a), np.array(b)
-        return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
-
-    sims = {k: cosine_sim(q_emb, v) for k, v in DEMO_EMBEDS.items()}
-    best_key = max(sims, key=sims.get)
-    best_score = sims[best_key]
-    if best_score >= threshold:
-        return best_key, best_score
-    return None, None
+engine = get_engine(demo_fingerprint(DEMO_RESPONSES))
 
 # ---------------- UI ----------------
 st.set_page_config(page_title="Autism Support Assistant", page_icon="🧩", layout="wide")
@@ -155,6 +162,10 @@ if "memory_manager" not in st.session_state or st.session_state.get("user_id") !
     st.session_state.user_id = user_id
     st.session_state.session_id = st.session_state.memory_manager.create_session(user_id, user_name)
     st.session_state.history = []
+    st.session_state.history_window = HISTORY_PAGE
+    st.session_state.render_cache = {}   # message key -> render segments, built once per finished message
+    st.session_state.archive = []        # earlier sessions loaded on demand, newest first
+    st.session_state.archive_cursor = 0
 
 # ---------------- First-time Personalized Greeting ----------------
 if "greeted" not in st.session_state or not st.session_state.greeted:
@@ -191,51 +202,130 @@ if "greeted" not in st.session_state or not st.session_state.greeted:
     st.session_state.greeted = True
     # st.stop()
 
-chat = st.container()
-for m in st.session_state.history:
+# ---------------- Chat History (windowed) ----------------
+def message_segments(m) -> list:
+    """What a finished message draws: ("md", html) and ("img", tag) segments, adjacent text merged."""
+    if m.get("is_demo"):
+        segments = []
+        for block in m["content"]:
+            if block["type"] == "text":
+                if segments and segments[-1][0] == "md":
+                    segments[-1] = ("md", segments[-1][1] + block["content"])
+                else:
+                    segments.append(("md", block["content"]))
+            elif block["type"] == "image" and block["tag"] in IMAGES:
+                segments.append(("img", block["tag"]))
+        return segments
+    tags = [t for t in dict.fromkeys(IMG_TOKEN.findall(m["content"])) if t in IMAGES]
+    return [("md", m["content"])] + [("img", t) for t in tags]
+
+def render_message(m, key):
+    cache = st.session_state.setdefault("render_cache", {})
+    segments = cache.get(key)
+    if segments is None:
+        segments = cache[key] = message_segments(m)
     with chat.chat_message(m["role"]):
-        if m.get("is_demo"):
-            for block in m["content"]:
-                if block["type"] == "text":
-                    st.markdown(block["content"], unsafe_allow_html=True)
-                elif block["type"] == "image" and block["tag"] in IMAGE_MAP:
-                    st.image(
-                        IMAGE_MAP[block["tag"]],
-                        caption=block["tag"].replace("_", " ").title(),
-                        width=500
-                    )
-        else:
-            st.markdown(m["content"], unsafe_allow_html=True)
+        for kind, value in segments:
+            if kind == "md":
+                st.markdown(value, unsafe_allow_html=True)
+            else:
+                show_image(value)
+
+chat = st.container()
+history = st.session_state.history
+window = st.session_state.setdefault("history_window", HISTORY_PAGE)
+first_shown = max(0, len(history) - window)
+
+if first_shown == 0 and st.session_state.get("archive_cursor") is not None:
+    if chat.button("⬆ Load earlier conversations", key="load_earlier_sessions"):
+        page, cursor = st.session_state.memory_manager.earlier_sessions(
+            st.session_state.session_id, st.session_state.get("archive_cursor", 0)
+        )
+        st.session_state.setdefault("archive", []).extend(page)
+        st.session_state.archive_cursor = cursor
+        st.rerun()
+
+if first_shown == 0:
+    for session in reversed(st.session_state.get("archive", [])):
+        chat.caption(f"Earlier conversation · {(session['created_at'] or '')[:16].replace('T', ' ')}")
+        if session["packed"]:
+            render_message(
+                {"role": "assistant", "content": "<i>Summary:</i> " + " ".join(session["packed"])},
+                ("archive", session["session_id"], "packed"),
+            )
+        for i, m in enumerate(session["recent"]):
+            render_message(m, ("archive", session["session_id"], i))
+    if st.session_state.get("archive"):
+        chat.divider()
+else:
+    if chat.button(f"⬆ Show {min(HISTORY_PAGE, first_shown)} earlier messages", key="show_earlier"):
+        st.session_state.history_window = window + HISTORY_PAGE
+        st.rerun()
+
+# only the last `window` messages are drawn, so a rerun costs the same however long the chat is
+for i in range(first_shown, len(history)):
+    render_message(history[i], ("history", i))
+
+# ---------------- Turn Metrics (sidebar debug panel) ----------------
+show_metrics = st.sidebar.toggle("Show turn metrics", value=METRICS_PANEL)
+metrics_slot = st.sidebar.empty()
+
+def render_metrics_panel():
+    record = st.session_state.get("last_turn_metrics")
+    if not show_metrics or not record:
+        return
+    with metrics_slot.container():
+        st.markdown(f"**Path:** {record['path']} · **Total:** {record['total_ms']:.0f} ms · **Cost:** ${record['cost_usd']:.5f}")
+        st.table({"stage": list(record["stages_ms"]), "ms": list(record["stages_ms"].values())})
+        if record["tokens"]:
+            st.json(record["tokens"], expanded=False)
+        if record["cache"]:
+            st.json(record["cache"], expanded=False)
+        st.caption("Startup (ms)")
+        st.json(WARMUP.report(), expanded=False)
+        if hasattr(engine.client, "stats"):
+            st.caption("OpenAI client saturation")
+            st.json(engine.client.stats(), expanded=False)
+
+def finish_turn(answer: str):
+    """Close the turn in the engine (answer cache + metrics log) and refresh the debug panel."""
+    st.session_state.last_turn_metrics = engine.finish(turn, answer)
+    render_metrics_panel()
+
+render_metrics_panel()
 
 # ---------------- User Input ----------------
 user_query = st.chat_input("Type your question here...")
 if not user_query:
     st.stop()
 
-normalized_query = user_query.lower().strip()
+with chat.chat_message("user"):
+    st.markdown(user_query)
 
-# ---------------- Memory: Check for Repeat Query ----------------
-found, cached_answer = st.session_state.memory_manager.find_recent_match(
-    st.session_state.session_id, user_query
+# Repeat detection, demo match, packed memory, answer cache, retrieval and prompt (engine.py)
+turn = engine.plan(
+    user_query, st.session_state.memory_manager, st.session_state.session_id, st.session_state.history
 )
-if found:
-    with chat.chat_message("user"):
-        st.markdown(user_query)
-    st.session_state.history.append({"role": "user", "content": user_query})
+st.session_state.history.append({"role": "user", "content": user_query})
 
+# ---------------- Memory: Repeat Query ----------------
+if turn.path == "repeat":
     with chat.chat_message("assistant"):
-        st.markdown(cached_answer, unsafe_allow_html=True)
+        st.markdown(turn.answer, unsafe_allow_html=True)
 
-    st.session_state.history.append({"role": "assistant", "content": cached_answer})
+    st.session_state.history.append({"role": "assistant", "content": turn.answer})
+    finish_turn(turn.answer)
     st.stop()
 
-# ---------------- Semantic Match in Demo Answers ----------------
-similar_key, score = find_similar_demo(normalized_query)
+st.session_state.memory_manager.add_message(
+    st.session_state.session_id, "user", user_query
+)
 
-if similar_key:
+# ---------------- Semantic Match in Demo Answers ----------------
+if turn.similar_key:
     st.markdown(
         f"<div style='padding:8px; border-radius:6px; color:yellow;'>"
-        f"<b>SIMILAR:</b> {similar_key}</div>",
+        f"<b>SIMILAR:</b> {turn.similar_key}</div>",
         unsafe_allow_html=True
     )
 else:
@@ -245,31 +335,21 @@ else:
         unsafe_allow_html=True
     )
 
-# ---------------- Memory: Search Packed Summaries ----------------
-found_summary, related_info = st.session_state.memory_manager.search_packed(
-    st.session_state.session_id, user_query
-)
-if found_summary:
+# ---------------- Memory: Packed Summaries ----------------
+if turn.related_info:
     st.markdown(
         f"<div style='padding:8px; border-radius:6px; color:lightgreen;'>"
-        f"<b>Found related past topic in memory:</b> {related_info}</div>",
+        f"<b>Found related past topic in memory:</b> {turn.related_info}</div>",
         unsafe_allow_html=True
     )
 
 # ---------------- DEMO ANSWER HANDLER ----------------
-if similar_key:
-    answer_blocks = DEMO_RESPONSES[similar_key]["answer"]
-
-    with chat.chat_message("user"):
-        st.markdown(user_query)
-    st.session_state.history.append({"role": "user", "content": user_query})
-    st.session_state.memory_manager.add_message(
-        st.session_state.session_id, "user", user_query
-    )
+if turn.path == "demo":
+    answer_blocks = turn.answer_blocks
 
     s = 4
     x = "Generating response..."
-    if similar_key in ["morning routine", "dressing independently"]:
+    if turn.similar_key in ["morning routine", "dressing independently"]:
         s = 8
         x = "Generating image..."
     with st.spinner(x):
@@ -279,12 +359,8 @@ if similar_key:
         for block in answer_blocks:
             if block["type"] == "text":
                 st.markdown(block["content"], unsafe_allow_html=True)
-            elif block["type"] == "image" and block["tag"] in IMAGE_MAP:
-                st.image(
-                    IMAGE_MAP[block["tag"]],
-                    caption=block["tag"].replace("_", " ").title(),
-                    width=500
-                )
+            elif block["type"] == "image" and block["tag"] in IMAGES:
+                show_image(block["tag"])
 
     st.session_state.history.append({
         "role": "assistant",
@@ -293,112 +369,68 @@ if similar_key:
     })
 
     # Store demo response in memory
-    text_answer = " ".join(
-        block["content"] for block in answer_blocks if block["type"] == "text"
-    )
     st.session_state.memory_manager.add_message(
-        st.session_state.session_id, "assistant", text_answer
+        st.session_state.session_id, "assistant", turn.answer
     )
+    finish_turn(turn.answer)
 
     st.stop()
 
-# ---------------- Language + Embedding Prep ----------------
-is_leb = detect_leb_chat(user_query)
-processed_query = normalize_for_embedding(user_query) if is_leb else user_query
-
-with chat.chat_message("user"):
-    st.markdown(user_query)
-st.session_state.history.append({"role": "user", "content": user_query})
-st.session_state.memory_manager.add_message(
-    st.session_state.session_id, "user", user_query
-)
-
-# ---------------- Retrieval ----------------
-query_embedding = client.embeddings.create(
-    model="text-embedding-3-small",
-    input=user_query
-).data[0].embedding
-
-q = collection.query(query_embeddings=[query_embedding], n_results=12)
-docs = q.get("documents", [[]])[0]
-metas = q.get("metadatas", [[]])[0]
-dists = q.get("distances", [[]])[0] if "distances" in q else [0.0] * len(docs)
-
-triples = [(d, m, s) for d, m, s in zip(docs, metas, dists) if s < 0.4]
-if not triples and docs:
-    triples = list(zip(docs[:2], metas[:2], dists[:2]))
-docs, metas = zip(*[(d, m) for d, m, _ in triples]) if triples else ([], [])
-
-context = compose_context(docs, metas, cap=12000)
-
-# ---------------- Prompt ----------------
-system_prompt = """
-You are a compassionate autism support guide for parents.
-Use KB excerpts if available, otherwise fallback to your knowledge.
-
-ALWAYS reply in this structured HTML format:
-<b>Goal:</b> ...
-<b>Why it matters:</b> ...
-<b>Step-by-step guide:</b> ...
-<b>Friendly tip:</b> ...
-<b>📚 References & Resources:</b> ...
-
-If visuals are relevant, reference them as [[image:tag]].
+# ---------------- Shared Answer Cache ----------------
+def show_sources(sources):
+    with st.expander("📖 Sources", expanded=False):
+        for src in sources:
+            st.markdown(f"**{src['source']}**\n\n{src['snippet']}")
 
-End every message with:
-"This is guidance, not diagnosis. You can always conduct free screening on our CereAura platform or book a session with a specialized therapist for diagnosis."
-
-Language rules:
-- If the parent speaks in Lebanese chat dialect (romanized Arabic like "keef nharak"), reply in the same dialect.
-- If the parent writes in English, reply in English.
-"""
-
-messages = [{"role": "system", "content": system_prompt}]
-for m in st.session_state.history:
-    if m.get("is_demo"):
-        demo_text = " ".join(
-            block["content"] for block in m["content"] if block["type"] == "text"
-        )
-        messages.append({"role": m["role"], "content": demo_text})
-    else:
-        messages.append({"role": m["role"], "content": m["content"]})
-
-if found_summary:
-    messages.append({
-        "role": "system",
-        "content": f"Here is a past related summary from previous interactions:\n{related_info}"
-    })
-
-kb_status = "STRONG_KB" if docs else "NO_KB"
-messages.append({
-    "role": "user",
-    "content": f"Parent's Question: {user_query}\n\n"
-               f"Relevant Knowledge Base Excerpts:\n{context if context else 'No relevant excerpts found.'}\n\n"
-               f"KB Status: {kb_status}"
-})
-
-# ---------------- GPT Response ----------------
-with st.spinner("Generating structured response..."):
-    resp = client.chat.completions.create(
-        model=CHAT_MODEL,
-        messages=messages,
-        temperature=0.4,
-        max_tokens=2000
+if turn.path == "cache":
+    with chat.chat_message("assistant"):
+        st.markdown(turn.answer, unsafe_allow_html=True)
+        render_images_from_answer(turn.answer)
+        if turn.sources:
+            show_sources(turn.sources)
+    st.session_state.history.append({"role": "assistant", "content": turn.answer})
+    st.session_state.memory_manager.add_message(
+        st.session_state.session_id, "assistant", turn.answer
     )
+    finish_turn(turn.answer)
+    st.stop()
 
-answer = resp.choices[0].message.content.strip()
+# ---------------- GPT Response ----------------
+def stream_answer(turn) -> str:
+    """Stream the completion into the current chat bubble; images appear as soon as their token closes."""
+    text_slot = st.empty()
+    text_slot.markdown("▌")
+    shown_images = set()
+    parts, last_paint = [], 0.0
+    for delta in engine.stream(turn):
+        parts.append(delta)
+        now = time.perf_counter()
+        if now - last_paint >= 0.05:  # repaint at most ~20x/s so long answers don't flood the websocket
+            text_slot.markdown("".join(parts) + "▌", unsafe_allow_html=True)
+            last_paint = now
+        if "]" in delta:
+            render_images_from_answer("".join(parts), shown_images)
+
+    answer = "".join(parts).strip()
+    text_slot.markdown(answer, unsafe_allow_html=True)
+    render_images_from_answer(answer, shown_images)
+    return answer
 
 with chat.chat_message("assistant"):
-    st.markdown(answer, unsafe_allow_html=True)
-    render_images_from_answer(answer)
-    if docs:
-        with st.expander("📖 Sources", expanded=False):
-            for d, m in zip(docs, metas):
-                src = m.get("file", m.get("source", "kb"))
-                snippet = d[:800] + ("…" if len(d) > 800 else "")
-                st.markdown(f"**{src}**\n\n{snippet}")
+    if STREAM_ANSWERS:
+        answer = stream_answer(turn)
+    else:
+        with st.spinner("Generating structured response..."):
+            answer = engine.complete(turn)
+        st.markdown(answer, unsafe_allow_html=True)
+        render_images_from_answer(answer)
+    if turn.sources:
+        show_sources(turn.sources)
 
 st.session_state.history.append({"role": "assistant", "content": answer})
 st.session_state.memory_manager.add_message(
     st.session_state.session_id, "assistant", answer
-)
\ No newline at end of file
+)
+
+# stores the answer in the shared cache when the turn depends on the question alone
+finish_turn(answer)
\ No newline at end of file
@@ -0,0 +1,455 @@
+"""
+Headless answer pipeline shared by the Streamlit app and offline replay.
+
+A turn goes through the same steps chat.py used to run at module level:
+    repeat detection -> demo match -> packed memory -> dialect + embedding
+    -> shared answer cache -> hybrid KB retrieval -> prompt -> generation
+and ends on one of the paths "repeat", "demo", "cache" or "kb".
+
+Batch mode replays queries from a JSONL file with a bounded worker pool:
+    python engine.py requests.jsonl -o answers.jsonl --workers 4
+It reads the shared answer cache but only writes to it with --store-answer-cache,
+so an offline replay never decides what live users are served.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import contextvars
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+
+env_path = Path(__file__).parent / ".env"
+load_dotenv(dotenv_path=env_path, override=True)
+
+from utils.dialect import analyze as analyze_dialect
+from utils.embeddings import embed_texts
+from utils.demo_index import load_demo_index
+from utils.context_builder import CONTEXT_TOKEN_BUDGET, MESSAGE_OVERHEAD, build_messages, count_tokens, truncate_tokens
+from utils.retrieval import KB_TOKEN_BUDGET, hybrid_search, pack_context
+from utils.bm25 import BM25Index
+from utils.answer_cache import get_answer_cache, read_kb_version
+from utils.openai_client import get_openai_client
+from utils.metrics import TurnMetrics, start_turn, end_turn, stage, observe_stage, record_usage, record_cache
+from demo_answers import DEMO_RESPONSES
+
+# ---------------- Env ----------------
+CHROMA_PATH = Path(os.getenv("CHROMA_PATH", "db"))
+COLLECTION_NAME = os.getenv("COLLECTION_NAME", "autism_bot")
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o-mini")
+DEMO_MATCH_THRESHOLD = 0.88
+PLAN_WORKERS = int(os.getenv("PLAN_WORKERS", "8"))  # threads for the concurrent pre-generation lookups
+QUESTION_TOKEN_LIMIT = int(os.getenv("QUESTION_TOKEN_LIMIT", "2000"))  # a pasted document is cut to this
+QUERY_FIELDS = ("query", "question", "text", "body", "title")  # tried in order for batch input lines
+
+SYSTEM_PROMPT = """
+You are a compassionate autism support guide for parents.
+Use KB excerpts if available, otherwise fallback to your knowledge.
+
+ALWAYS reply in this structured HTML format:
+<b>Goal:</b> ...
+<b>Why it matters:</b> ...
+<b>Step-by-step guide:</b> ...
+<b>Friendly tip:</b> ...
+<b>📚 References & Resources:</b> ...
+
+If visuals are relevant, reference them as [[image:tag]].
+
+End every message with:
+"This is guidance, not diagnosis. You can always conduct free screening on our CereAura platform or book a session with a specialized therapist for diagnosis."
+
+Language rules:
+- If the parent speaks in Lebanese chat dialect (romanized Arabic like "keef nharak"), reply in the same dialect.
+- If the parent writes in English, reply in English.
+"""
+
+
+def demo_text(blocks: List[Dict]) -> str:
+    return " ".join(block["content"] for block in blocks if block["type"] == "text")
+
+def history_turns(history):
+    """History as plain {"role", "content"} turns; demo answers are flattened to their text blocks."""
+    for m in history:
+        if m.get("is_demo"):
+            yield {"role": m["role"], "content": demo_text(m["content"])}
+        else:
+            yield {"role": m["role"], "content": m["content"]}
+
+
+@dataclass
+class Turn:
+    query: str
+    path: str = "kb"                      # repeat | demo | cache | kb
+    answer: str = ""
+    answer_blocks: Optional[List[Dict]] = None   # demo answers keep their text/image blocks
+    similar_key: Optional[str] = None
+    related_info: Optional[str] = None    # best packed-memory match, if any
+    is_leb: bool = False
+    processed_query: str = ""
+    query_embedding: object = None
+    kb_version: str = ""
+    sources: List[Dict] = field(default_factory=list)
+    messages: Optional[List[Dict]] = None
+    cacheable: bool = False
+    metrics: Optional[TurnMetrics] = None
+
+
+_plan_pool = None
+_plan_pool_lock = threading.Lock()
+
+def get_plan_pool() -> ThreadPoolExecutor:
+    global _plan_pool
+    with _plan_pool_lock:
+        if _plan_pool is None:
+            _plan_pool = ThreadPoolExecutor(max_workers=PLAN_WORKERS, thread_name_prefix="plan")
+        return _plan_pool
+
+
+def format_question(query: str, context: str, kb_status: str) -> str:
+    return (
+        f"Parent's Question: {query}\n\n"
+        f"Relevant Knowledge Base Excerpts:\n{context if context else 'No relevant excerpts found.'}\n\n"
+        f"KB Status: {kb_status}"
+    )
+
+
+class AnswerEngine:
+    """
+    One instance per process; safe to share between threads. Per-user state
+    (MemoryManager, session id, UI history) is passed in on every call.
+    """
+
+    def __init__(self, client=None, collection=None, use_answer_cache: bool = True, store_answer_cache: bool = True):
+        self.client = client or get_openai_client()
+        if collection is None:
+            import chromadb  # slow to import; deferred so the UI can start without it
+            chroma_client = chromadb.PersistentClient(path=str(CHROMA_PATH))
+            collection = chroma_client.get_or_create_collection(name=COLLECTION_NAME)
+        self.collection = collection
+        self.use_answer_cache = use_answer_cache
+        self.store_answer_cache = use_answer_cache and store_answer_cache
+        self.demo_index = load_demo_index(self.client, DEMO_RESPONSES)
+        self._lexical = (None, None)      # (kb_version, BM25Index | None)
+        self._lexical_lock = threading.Lock()
+
+    def lexical_index(self, kb_version: str):
+        """BM25 index written by fill_db.py; reloaded when the KB version changes (None if not built yet)."""
+        with self._lexical_lock:
+            if self._lexical[0] != kb_version:
+                self._lexical = (kb_version, BM25Index.load())
+            return self._lexical[1]
+
+    def match_demo(self, query_embedding, threshold: float = DEMO_MATCH_THRESHOLD):
+        matches = self.demo_index.match(query_embedding, k=1)
+        if matches and matches[0][1] >= threshold:
+            return matches[0]
+        return None, None
+
+    def retrieve(self, turn: Turn, stop: threading.Event = None):
+        """Hybrid KB search and context packing; returns (context, chunks, n candidates) or None if stopped."""
+        stopped = stop.is_set if stop is not None else None
+        with stage("retrieval"):
+            candidates = hybrid_search(
+                self.collection, self.lexical_index(turn.kb_version), turn.processed_query,
+                turn.query_embedding, n_results=12, should_stop=stopped
+            )
+        if stopped is not None and stopped():
+            return None
+        docs = [c["text"] for c in candidates]
+        metas = [c["metadata"] for c in candidates]
+        cand_embs = [c["embedding"] for c in candidates]
+
+        # MMR over Chroma's embeddings, overlap merge, then pack to what the prompt budget leaves for excerpts
+        with stage("context_pack"):
+            context, kb_chunks = pack_context(
+                turn.query_embedding, docs, metas, cand_embs if all(e is not None for e in cand_embs) else None,
+                budget=self.kb_budget(turn.query),
+            )
+        return context, kb_chunks, len(docs)
+
+    @staticmethod
+    def question_budget() -> int:
+        """QUESTION_TOKEN_LIMIT, cut down so the system prompt and question always fit CONTEXT_TOKEN_BUDGET."""
+        fixed = count_tokens(SYSTEM_PROMPT) + count_tokens(format_question("", "", "STRONG_KB"))
+        return max(1, min(QUESTION_TOKEN_LIMIT, CONTEXT_TOKEN_BUDGET - fixed - 2 * MESSAGE_OVERHEAD - 16))
+
+    @staticmethod
+    def kb_budget(query: str) -> int:
+        """KB_TOKEN_BUDGET, cut down so the system prompt, question and excerpts fit CONTEXT_TOKEN_BUDGET."""
+        fixed = count_tokens(SYSTEM_PROMPT) + count_tokens(format_question(query, "", "STRONG_KB"))
+        slack = 2 * MESSAGE_OVERHEAD + 8  # segment joins may tokenize a little differently than counted apart
+        return max(0, min(KB_TOKEN_BUDGET, CONTEXT_TOKEN_BUDGET - fixed - slack))
+
+    def _lookup_answer_cache(self, turn: Turn):
+        with stage("answer_cache"):
+            cached = get_answer_cache().lookup(turn.query_embedding, self.answer_lang(turn), turn.kb_version)
+        record_cache("answer", hits=int(bool(cached)), misses=int(not cached))
+        return cached
+
+    @staticmethod
+    def _search_packed(memory, session_id: str, query: str, query_embedding):
+        with stage("packed_search"):
+            found_summary, related_info = memory.search_packed(session_id, query, query_embedding=query_embedding)
+        return related_info if found_summary else None
+
+    # ---------------- Turn Planning ----------------
+    def plan(self, query: str, memory=None, session_id: str = None, history: List[Dict] = ()) -> Turn:
+        """
+        Run every step up to generation. history holds the earlier UI turns without
+        the current question. For the "kb" path turn.messages is ready to send;
+        every other path already carries its answer.
+
+        The raw and dialect-normalized query are embedded in one request, then the
+        demo match, packed-memory search, answer-cache lookup and KB retrieval run
+        concurrently; KB work is stopped as soon as a demo match or cached answer wins.
+        """
+        turn = Turn(query=query, metrics=start_turn(user_id=getattr(memory, "user_id", None)))
+
+        if memory is not None:
+            with stage("repeat_check"):
+                found, cached_answer = memory.find_recent_match(session_id, query)
+            record_cache("repeat", hits=int(found), misses=int(not found))
+            if found:
+                turn.path, turn.answer = "repeat", cached_answer
+                return turn
+
+        # valid input can be longer than the prompt (or the embedding model) takes; answer its beginning
+        query = truncate_tokens(query, self.question_budget())
+
+        # one pass over the compiled lexicon both detects the dialect and rewrites it for retrieval
+        with stage("dialect"):
+            dialect = analyze_dialect(query)
+        turn.is_leb = dialect.is_leb
+        turn.processed_query = dialect.text if dialect.is_leb else query  # a stray hit ("Habib") is not rewritten
+        with stage("embed_query"):
+            # demo keys and packed summaries are matched on the parent's own words, the KB on the normalized form
+            raw_embedding, turn.query_embedding = embed_texts(self.client, [query, turn.processed_query])
+        turn.kb_version = read_kb_version()
+
+        # copy_context() so stage timings on the pool threads are attributed to this turn
+        pool, stop = get_plan_pool(), threading.Event()
+        run = lambda fn, *args: pool.submit(contextvars.copy_context().run, fn, *args)
+        # only a turn with no earlier questions may be answered from (or feed) the shared answer cache
+        has_user_history = any(m["role"] == "user" for m in history)
+        kb_future = run(self.retrieve, turn, stop)
+        cache_future = run(self._lookup_answer_cache, turn) if self.use_answer_cache and not has_user_history else None
+        packed_future = run(self._search_packed, memory, session_id, query, raw_embedding) if memory is not None else None
+
+        try:
+            with stage("demo_match"):
+                turn.similar_key, _ = self.match_demo(raw_embedding)
+            record_cache("demo", hits=int(bool(turn.similar_key)), misses=int(not turn.similar_key))
+            if turn.similar_key:
+                stop.set()
+
+            if packed_future is not None:
+                turn.related_info = packed_future.result()
+
+            if turn.similar_key:
+                turn.path = "demo"
+                turn.answer_blocks = DEMO_RESPONSES[turn.similar_key]["answer"]
+                turn.answer = demo_text(turn.answer_blocks)
+                return turn
+
+            summaries = [turn.related_info] if turn.related_info else []
+            if memory is not None:
+                with stage("packed_summaries"):
+                    summaries += [s for s in memory.packed_summaries(session_id) if s not in summaries]
+
+            # recalled memory makes the answer personal, so a generic cached one is not served
+            cached = cache_future.result() if cache_future is not None and not summaries else None
+            if cached:
+                stop.set()
+                turn.path, turn.answer = "cache", cached["answer"]
+                turn.sources = cached["sources"]
+                return turn
+
+            context, kb_chunks, n_docs = kb_future.result()
+        finally:
+            if stop.is_set():
+                kb_future.cancel()
+                turn.metrics.labels["kb_cancelled"] = True
+
+        turn.sources = [
+            {
+                "source": c["metadata"].get("file", c["metadata"].get("source", "kb")),
+                "snippet": c["text"][:800] + ("…" if len(c["text"]) > 800 else ""),
+            }
+            for c in kb_chunks
+        ]
+
+        question = format_question(query, context, "STRONG_KB" if n_docs else "NO_KB")
+
+        # A turn with no earlier questions and no recalled memory depends only on the question itself:
+        # its answer is built without the (personalised) greeting and may be shared through the answer cache.
+        turn.cacheable = not summaries and not has_user_history
+        with stage("prompt"):
+            turn.messages = build_messages(
+                SYSTEM_PROMPT, question, [] if turn.cacheable else list(history_turns(history)), summaries
+            )
+        return turn
+
+    @staticmethod
+    def answer_lang(turn: Turn) -> str:
+        return "leb" if turn.is_leb else "en"
+
+    # ---------------- Generation ----------------
+    def complete(self, turn: Turn) -> str:
+        with stage("generation"):
+            resp = self.client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=turn.messages,
+                temperature=0.4,
+                max_tokens=2000
+            )
+        record_usage(CHAT_MODEL, resp.usage)
+        return resp.choices[0].message.content.strip()
+
+    def stream(self, turn: Turn) -> Iterator[str]:
+        """Yield answer deltas as they arrive; the final usage chunk is recorded in the turn metrics."""
+        started = time.perf_counter()
+        first = True
+        with stage("generation"):
+            stream = self.client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=turn.messages,
+                temperature=0.4,
+                max_tokens=2000,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    record_usage(CHAT_MODEL, chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first:
+                        observe_stage("first_token", time.perf_counter() - started)
+                        first = False
+                    yield delta
+
+    def finish(self, turn: Turn, answer: str) -> dict:
+        """
+        Close the turn on any path: record the answer, share it through the answer cache
+        when allowed, and write the turn's metrics. Returns the metrics record.
+        """
+        turn.answer = answer
+        if self.store_answer_cache and turn.cacheable and answer:
+            with stage("answer_cache_store"):
+                get_answer_cache().store(
+                    turn.query, turn.query_embedding, self.answer_lang(turn), turn.kb_version, answer, turn.sources
+                )
+        if turn.metrics is None:
+            return {}
+        turn.metrics.labels.update(is_leb=turn.is_leb, kb_chunks=len(turn.sources), cacheable=turn.cacheable)
+        return end_turn(turn.metrics, turn.path)
+
+    def answer(self, query: str, memory=None, session_id: str = None, history: List[Dict] = ()) -> Turn:
+        """Plan and, on the KB path, generate; the returned turn carries answer, path and sources."""
+        turn = self.plan(query, memory, session_id, history)
+        self.finish(turn, self.complete(turn) if turn.path == "kb" else turn.answer)
+        return turn
+
+
+# ---------------- Batch Mode ----------------
+def read_queries(path: Path, field_name: str = None) -> Iterator[Dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"[Warning] {path}:{line_no}: skipped invalid JSON ({e})")
+                continue
+            fields = (field_name,) if field_name else QUERY_FIELDS
+            query = next((record[k] for k in fields if isinstance(record.get(k), str) and record[k].strip()), None)
+            if query is None:
+                print(f"[Warning] {path}:{line_no}: no query field")
+                continue
+            yield {"line": line_no, "id": record.get("id", record.get("request_id")), "query": query}
+
+def run_one(engine: AnswerEngine, item: Dict) -> Dict:
+    started = time.perf_counter()
+    out = {"line": item["line"], "id": item["id"], "query": item["query"]}
+    try:
+        turn = engine.answer(item["query"])
+        out.update(path=turn.path, answer=turn.answer, sources=turn.sources, error=None,
+                   stages_ms=turn.metrics.record["stages_ms"], tokens=turn.metrics.record["tokens"])
+    except Exception as e:
+        out.update(path="error", answer=None, sources=[], error=f"{type(e).__name__}: {e}")
+    out["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return out
+
+def run_batch(engine: AnswerEngine, items, out_file, workers: int) -> List[Dict]:
+    """Answer items on a thread pool with at most 2*workers queries in flight; results are written as they finish."""
+    results = []
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        while True:
+            while len(pending) < 2 * workers:
+                item = next(items, None)
+                if item is None:
+                    break
+                pending.add(pool.submit(run_one, engine, item))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                result = fut.result()
+                out_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out_file.flush()
+                results.append(result)
+    return results
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of queries without the UI.")
+    parser.add_argument("input", type=Path, help="JSONL file, one query per line")
+    parser.add_argument("-o", "--output", type=Path, default=None, help="answers JSONL (default: stdout)")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent queries")
+    parser.add_argument("--field", default=None, help=f"query field (default: first of {', '.join(QUERY_FIELDS)})")
+    parser.add_argument("--no-answer-cache", action="store_true",
+                        help="neither read nor write the shared answer cache")
+    parser.add_argument("--store-answer-cache", action="store_true",
+                        help="also write generated answers to the shared answer cache served to live users")
+    args = parser.parse_args()
+
+    engine = AnswerEngine(use_answer_cache=not args.no_answer_cache, store_answer_cache=args.store_answer_cache)
+    out_file = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    t0 = time.perf_counter()
+    try:
+        results = run_batch(engine, read_queries(args.input, args.field), out_file, max(1, args.workers))
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
+    elapsed = time.perf_counter() - t0
+
+    latencies = [r["latency_ms"] for r in results if r["error"] is None]
+    paths = Counter(r["path"] for r in results)
+    print(
+        f"✅ {len(results)} queries in {elapsed:.1f}s ({len(results) / max(elapsed, 1e-9):.2f} q/s), "
+        f"p50 {percentile(latencies, 50):.0f} ms, p95 {percentile(latencies, 95):.0f} ms, "
+        f"paths {dict(paths)}",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
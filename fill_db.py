@@ -1,52 +1,315 @@
-import os, hashlib
+import os, json, time, hashlib, argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from dotenv import load_dotenv
 
+# loaded before the utils imports, which read their settings (EMBED_MODEL, cache paths, ...) at import time
+env_path = Path(__file__).parent / ".env"
+load_dotenv(dotenv_path=env_path, override=True)
+
 import chromadb
-from openai import OpenAI
-from langchain_community.document_loaders import PyPDFDirectoryLoader, Docx2txtLoader
+from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-env_path = Path(__file__).parent / ".env"
-load_dotenv(dotenv_path=env_path, override=True)
+from utils.embeddings import EMBED_MODEL, embed_texts
+from utils.openai_client import get_openai_client
+from utils.answer_cache import bump_kb_version
+from utils.bm25 import BM25Index, BM25_INDEX_PATH
+from utils.files import file_sha256
 
 DATA_PATH = Path("data")
 CHROMA_PATH = Path(os.getenv("CHROMA_PATH", "db"))
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "autism_bot")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+MANIFEST_PATH = Path(os.getenv("INGEST_MANIFEST", str(CHROMA_PATH / "ingest_manifest.json")))
+LOADERS = {".pdf": PyPDFLoader, ".docx": Docx2txtLoader}
+
+# ---------------- Batching Limits ----------------
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "128"))        # inputs per embeddings request
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "60000"))  # approx. tokens per embeddings request
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "512"))      # records per Chroma upsert
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))  # parse/split processes
+
+
+# ---------------- Batching Helpers ----------------
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 chars per token) used to size embedding requests."""
+    return len(text) // 4 + 1
+
+def iter_batches(records, max_items: int, max_tokens: int):
+    """Group records into batches bounded by item count and estimated tokens."""
+    batch, tokens = [], 0
+    for rec in records:
+        n = estimate_tokens(rec["text"])
+        if batch and (len(batch) >= max_items or tokens + n > max_tokens):
+            yield batch
+            batch, tokens = [], 0
+        batch.append(rec)
+        tokens += n
+    if batch:
+        yield batch
+
+def upsert_batch(collection, records):
+    """Upsert records in one Chroma call; split in half and retry if the batch is too large."""
+    try:
+        collection.upsert(
+            ids=[r["id"] for r in records],
+            documents=[r["text"] for r in records],
+            embeddings=[r["embedding"] for r in records],
+            metadatas=[r["metadata"] for r in records],
+        )
+    except ValueError as e:
+        if len(records) == 1:
+            raise
+        mid = len(records) // 2
+        print(f"\n[Warning] Upsert batch of {len(records)} rejected ({e}), splitting.")
+        upsert_batch(collection, records[:mid])
+        upsert_batch(collection, records[mid:])
+
+
+# ---------------- Manifest ----------------
+def load_manifest() -> dict:
+    if MANIFEST_PATH.exists():
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {"files": {}}
+
+def save_manifest(manifest: dict):
+    """Write the manifest atomically so an interrupted run never leaves it half-written."""
+    MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = MANIFEST_PATH.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, MANIFEST_PATH)
+
+def scan_data_dir() -> dict:
+    """Return {relative path: stat} for every supported document in DATA_PATH."""
+    if not DATA_PATH.exists():
+        return {}
+    return {
+        p.relative_to(DATA_PATH).as_posix(): p.stat()
+        for p in sorted(DATA_PATH.iterdir())
+        if p.is_file() and p.suffix.lower() in LOADERS
+    }
+
+def plan_changes(manifest: dict):
+    """
+    Compare DATA_PATH against the manifest.
+    Returns (changed {rel: entry-without-chunk-ids}, removed [rel], touched {rel: entry}).
+    Files whose size and mtime are unchanged are not re-hashed; files whose
+    mtime moved but whose content hash is the same only get their stat refreshed.
+    """
+    known = manifest["files"]
+    current = scan_data_dir()
+    changed, touched = {}, {}
+    for rel, st in current.items():
+        entry = known.get(rel)
+        if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            continue
+        sha = file_sha256(DATA_PATH / rel)
+        if entry and entry["sha256"] == sha:
+            touched[rel] = {**entry, "size": st.st_size, "mtime": st.st_mtime}
+        else:
+            changed[rel] = {"sha256": sha, "size": st.st_size, "mtime": st.st_mtime}
+    removed = [rel for rel in known if rel not in current]
+    return changed, removed, touched
+
+
+# ---------------- Ingest ----------------
+def load_file_chunks(rel: str):
+    path = DATA_PATH / rel
+    docs = LOADERS[path.suffix.lower()](str(path)).load()
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
+    return splitter.split_documents(docs)
+
+def to_records(chunks):
+    """Turn split documents into unique {id, text, metadata} records (ids are MD5 of text)."""
+    records, seen = [], set()
+    for chunk in chunks:
+        text = chunk.page_content.strip()
+        if not text:
+            continue
+        uid = hashlib.md5(text.encode("utf-8")).hexdigest()
+        if uid in seen:
+            continue
+        seen.add(uid)
+        records.append({"id": uid, "text": text, "metadata": chunk.metadata})
+    return records
+
+def parse_file(rel: str):
+    """
+    Process-pool worker: load and split one file into records.
+    Returns (rel, records, error); a file that can't be parsed gives (rel, None, message)
+    instead of raising, so one bad document doesn't stop the rest of the sync.
+    """
+    try:
+        return rel, to_records(load_file_chunks(rel)), None
+    except Exception as e:
+        return rel, None, f"{e.__class__.__name__}: {e}"
+
+def iter_parsed(rels, workers: int):
+    """
+    Parse and split files in a process pool, yielding (rel, records, error) as each file finishes.
+    At most 2 * workers files are in flight, so memory stays bounded by that window
+    rather than by the size of the corpus.
+    """
+    rels = iter(rels)
+    if workers <= 1:
+        for rel in rels:
+            yield parse_file(rel)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        for rel in rels:
+            in_flight.add(pool.submit(parse_file, rel))
+            if len(in_flight) >= 2 * workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    yield fut.result()
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                yield fut.result()
+
+def ingest(client, collection, records, upsert_limit: int = UPSERT_BATCH_SIZE, total: int = None) -> int:
+    """Embed and upsert records (any iterable, consumed lazily) in size-bounded batches, reporting throughput."""
+    start = time.perf_counter()
+    pending, done = [], 0
+    for batch in iter_batches(records, EMBED_BATCH_SIZE, EMBED_BATCH_TOKENS):
+        embeddings = embed_texts(client, [r["text"] for r in batch], EMBED_MODEL)
+        for rec, emb in zip(batch, embeddings):
+            rec["embedding"] = emb.tolist()
+        pending.extend(batch)
+        while len(pending) >= upsert_limit:
+            upsert_batch(collection, pending[:upsert_limit])
+            pending = pending[upsert_limit:]
+
+        done += len(batch)
+        elapsed = time.perf_counter() - start
+        progress = f"{done}/{total}" if total else f"{done}"
+        print(f"\r⏳ {progress} chunks embedded • {done / max(elapsed, 1e-9):.1f} chunks/s", end="", flush=True)
+
+    if pending:
+        upsert_batch(collection, pending)
+
+    elapsed = time.perf_counter() - start
+    if done:
+        print(f"\n⏱️ {done} chunks in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.1f} chunks/s)")
+    return done
+
+
+def delete_ids(collection, ids, batch_size: int):
+    ids = sorted(ids)
+    for i in range(0, len(ids), batch_size):
+        collection.delete(ids=ids[i:i + batch_size])
+
+def build_lexical_index(collection, page_size: int):
+    """Rebuild the on-disk BM25 index from every chunk currently in the collection."""
+    def records():
+        offset = 0
+        while True:
+            page = collection.get(include=["documents"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                return
+            yield from zip(page["ids"], page["documents"])
+            offset += len(page["ids"])
+
+    start = time.perf_counter()
+    index = BM25Index.build(records())
+    index.save(BM25_INDEX_PATH)
+    print(f"🔎 BM25 index: {len(index)} chunks, {len(index.terms)} terms in {time.perf_counter() - start:.1f}s")
+
+def sync(client, collection, upsert_limit: int, workers: int = INGEST_WORKERS) -> bool:
+    """
+    Bring the collection in line with DATA_PATH using the ingest manifest.
+    Only new or changed files are loaded and split; only chunk IDs that are not
+    already stored are embedded; chunk IDs no file references any more are deleted.
+    Files are parsed in a process pool and their chunks stream straight into
+    embedding, so the first batches are sent before the last file is parsed.
+    Returns True if anything changed.
+    """
+    manifest = load_manifest()
+    changed, removed, touched = plan_changes(manifest)
+    if not (changed or removed or touched):
+        return False
+
+    old_files = manifest["files"]
+    stored_ids = {cid for entry in old_files.values() for cid in entry["chunk_ids"]}
+
+    new_files = {rel: entry for rel, entry in old_files.items() if rel not in removed}
+    new_files.update(touched)
+    for rel in removed:
+        print(f"🗑️ Removing {rel}")
+
+    failed = []
+
+    def new_records():
+        queued = set()
+        for rel, records, error in iter_parsed(changed, workers):
+            if error is not None:
+                # left out of the manifest (or kept at its previous version), so the next pass retries it
+                print(f"\n[Warning] Skipping {rel}, could not parse it: {error}")
+                failed.append(rel)
+                continue
+            print(f"\n📄 {'Updated' if rel in old_files else 'Added'} {rel} ({len(records)} chunks)")
+            new_files[rel] = {**changed[rel], "chunk_ids": [r["id"] for r in records]}
+            for r in records:
+                if r["id"] not in stored_ids and r["id"] not in queued:
+                    queued.add(r["id"])
+                    yield r
+
+    added = ingest(client, collection, new_records(), upsert_limit)
+
+    live_ids = {cid for entry in new_files.values() for cid in entry["chunk_ids"]}
+    stale = stored_ids - live_ids
+    if stale:
+        delete_ids(collection, stale, upsert_limit)
+
+    manifest["files"] = new_files
+    save_manifest(manifest)
+    if added or stale:
+        build_lexical_index(collection, upsert_limit)
+        bump_kb_version()  # invalidates cached answers built on the previous KB
+    print(f"✅ {COLLECTION_NAME}: {added} chunks added, {len(stale)} stale chunks deleted "
+          f"({len(changed) - len(failed)} changed, {len(removed)} removed, {len(failed)} failed files)")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest data/ documents into the Chroma knowledge base.")
+    parser.add_argument("--watch", action="store_true", help="keep running and ingest changes to data/ as they appear")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between scans in --watch mode")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="processes used to parse and split files")
+    args = parser.parse_args()
+
+    if not OPENAI_API_KEY:
+        raise ValueError("⚠️ Missing OPENAI_API_KEY in .env")
+
+    client = get_openai_client()  # pooled, rate-limited, retries 429s/5xx instead of aborting the run
+    chroma_client = chromadb.PersistentClient(path=str(CHROMA_PATH))
+    collection = chroma_client.get_or_create_collection(name=COLLECTION_NAME)
+    upsert_limit = UPSERT_BATCH_SIZE
+    if hasattr(chroma_client, "get_max_batch_size"):
+        upsert_limit = min(upsert_limit, chroma_client.get_max_batch_size())
+
+    if not sync(client, collection, upsert_limit, args.workers):
+        print(f"✅ {COLLECTION_NAME} is up to date")
+        if not BM25_INDEX_PATH.exists():
+            build_lexical_index(collection, upsert_limit)
+
+    if args.watch:
+        print(f"👀 Watching {DATA_PATH}/ every {args.interval:g}s (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(args.interval)
+                try:
+                    sync(client, collection, upsert_limit, args.workers)
+                except Exception as e:
+                    print(f"\n[Warning] Ingest pass failed, will retry next scan: {e}")
+        except KeyboardInterrupt:
+            print("\n👋 Stopped watching")
+
 
-if not OPENAI_API_KEY:
-    raise ValueError("⚠️ Missing OPENAI_API_KEY in .env")
-
-client = OpenAI(api_key=OPENAI_API_KEY)
-chroma_client = chromadb.PersistentClient(path=str(CHROMA_PATH))
-collection = chroma_client.get_or_create_collection(name=COLLECTION_NAME)
-
-# load docs
-docs = []
-if DATA_PATH.exists():
-    docs.extend(PyPDFDirectoryLoader(str(DATA_PATH)).load())
-    for docx_file in DATA_PATH.glob("*.docx"):
-        docs.extend(Docx2txtLoader(str(docx_file)).load())
-
-splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
-chunks = splitter.split_documents(docs)
-
-added = 0
-for chunk in chunks:
-    text = chunk.page_content.strip()
-    if not text:
-        continue
-    uid = hashlib.md5(text.encode("utf-8")).hexdigest()
-    embedding = client.embeddings.create(
-        model="text-embedding-3-small", input=text
-    ).data[0].embedding
-    collection.upsert(
-        documents=[text],
-        embeddings=[embedding],
-        metadatas=[chunk.metadata],
-        ids=[uid]
-    )
-    added += 1
-
-print(f"✅ Added {added} chunks into {COLLECTION_NAME}")
+if __name__ == "__main__":
+    main()
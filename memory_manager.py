@@ -1,6 +1,9 @@
 import json
 import os
 import uuid
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 from difflib import SequenceMatcher
 from typing import List, Dict, Tuple
@@ -8,54 +11,163 @@ from pathlib import Path
 
 from dotenv import load_dotenv
 
-# ---------------- Env ----------------
 env_path = Path(__file__).parent / ".env"
 load_dotenv(dotenv_path=env_path, override=True)
 
+from utils.session_store import make_store
+from utils.repeat_detector import RepeatDetector
+from utils.packed_index import PackedIndex
+from utils.embeddings import embed_text, embed_texts
+from utils.metrics import stage, record_usage
+from utils.openai_client import get_openai_client
+
+# ---------------- Env ----------------
 CHROMA_PATH = Path(os.getenv("CHROMA_PATH", "db"))
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "autism_bot")
 CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o-mini")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+SESSION_STORAGE = os.getenv("SESSION_STORAGE", "json")  # json | journal | sqlite
+PACK_IN_BACKGROUND = os.getenv("PACK_IN_BACKGROUND", "1") == "1"  # summarize off the chat turn
+PACK_WORKERS = int(os.getenv("PACK_WORKERS", "2"))
+PACKED_MATCH_THRESHOLD = float(os.getenv("PACKED_MATCH_THRESHOLD", "0.45"))  # cosine, packed-summary recall
+
+# ---------------- Summarization Backend ----------------
+# openai: CHAT_MODEL call | bart: local facebook/bart-large-cnn | extractive: CPU-only, no network
+# (utils/extractive_summarizer.py). `python bench_summarizers.py` compares their latency.
+SUMMARIZER_BACKEND = os.getenv("SUMMARIZER_BACKEND", "openai").lower()
+
+_summarizer = None
+_summarizer_lock = threading.Lock()
 
-# ---------------- Summarization Toggle ----------------
-USE_OPENAI = True  # ← Toggle this to False to use local BART model
+def get_summarizer():
+    """Local BART pipeline, loaded on first use (it takes seconds and ~1.6 GB) instead of at import."""
+    global _summarizer
+    with _summarizer_lock:
+        if _summarizer is None:
+            from transformers import pipeline
+            _summarizer = pipeline("summarization", model="facebook/bart-large-cnn")
+        return _summarizer
 
-if USE_OPENAI:
-    from openai import OpenAI
-    client = OpenAI(api_key=OPENAI_API_KEY)
-else:
-    from transformers import pipeline
-    summarizer = pipeline("summarization", model="facebook/bart-large-cnn")
+def warm_summarizer():
+    """Load the configured summarizer ahead of the first pack (see utils/warmup.py)."""
+    if SUMMARIZER_BACKEND == "bart":
+        get_summarizer()
+
+def get_embed_client():
+    """Embeddings always go through OpenAI, whichever backend writes the summaries."""
+    return get_openai_client()
 
 # ---------------- Summarizer Function ----------------
-def summarize_text(text: str) -> str:
-    """Summarize text using either OpenAI API or local BART model."""
+def _summarize_openai(text: str) -> str:
+    response = get_openai_client().chat.completions.create(
+        model=CHAT_MODEL,
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant that summarizes text concisely."},
+            {"role": "user", "content": f"Summarize the following text:\n\n{text}"}
+        ],
+        max_tokens=150,
+    )
+    record_usage(CHAT_MODEL, response.usage)
+    return response.choices[0].message.content.strip()
+
+def _summarize_bart(text: str) -> str:
+    return get_summarizer()(text, max_length=100, min_length=30, do_sample=False)[0]['summary_text']
+
+def _summarize_extractive(text: str) -> str:
+    from utils.extractive_summarizer import summarize
+    return summarize(text)
+
+SUMMARIZERS = {
+    "openai": _summarize_openai,
+    "bart": _summarize_bart,
+    "extractive": _summarize_extractive,
+}
+
+if SUMMARIZER_BACKEND not in SUMMARIZERS:
+    print(f"[Warning] Unknown SUMMARIZER_BACKEND {SUMMARIZER_BACKEND!r}, using openai")
+    SUMMARIZER_BACKEND = "openai"
+
+def summarize_text(text: str, backend: str = None) -> str:
+    """Summarize text with the configured backend (or the one given), truncating on failure."""
     try:
-        if USE_OPENAI:
-            response = client.chat.completions.create(
-                model=CHAT_MODEL,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that summarizes text concisely."},
-                    {"role": "user", "content": f"Summarize the following text:\n\n{text}"}
-                ],
-                max_tokens=150,
-            )
-            return response.choices[0].message.content.strip()
-        else:
-            return summarizer(text, max_length=100, min_length=30, do_sample=False)[0]['summary_text']
+        with stage("summarize"):
+            return SUMMARIZERS[backend or SUMMARIZER_BACKEND](text)
     except Exception as e:
         print(f"[Warning] Summarization failed: {e}")
         return text[:400]  # fallback truncation
 
 
+# ---------------- Background Packing ----------------
+class PackWorker:
+    """
+    Thread pool for pack jobs with at most one job per key (one key per session).
+    A job submitted while the same key is already queued or running is coalesced:
+    the running job is simply run once more when it finishes, picking up
+    everything that accumulated in the meantime.
+    """
+
+    def __init__(self, max_workers: int = PACK_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pack")
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._rerun = set()
+
+    def submit(self, key, fn):
+        with self._lock:
+            if key in self._pending:
+                self._rerun.add(key)
+                return self._pending[key]
+            future = self._pool.submit(self._run, key, fn)
+            self._pending[key] = future
+            return future
+
+    def _run(self, key, fn):
+        while True:
+            try:
+                fn()
+            except Exception as e:
+                print(f"[Warning] Background packing failed: {e}")
+            with self._lock:
+                if key in self._rerun:
+                    self._rerun.discard(key)
+                    continue
+                del self._pending[key]
+                return
+
+    def flush(self, timeout: float = None, keys=None) -> bool:
+        """Wait for pending jobs (all, or only those in keys). Returns False on timeout."""
+        with self._lock:
+            futures = [f for k, f in self._pending.items() if keys is None or k in keys]
+        _, not_done = wait(futures, timeout=timeout)
+        return not not_done
+
+_pack_worker = None
+_pack_worker_lock = threading.Lock()
+
+def get_pack_worker() -> PackWorker:
+    global _pack_worker
+    with _pack_worker_lock:
+        if _pack_worker is None:
+            _pack_worker = PackWorker()
+            atexit.register(_pack_worker.flush)
+        return _pack_worker
+
+
 # ---------------- Memory Manager ----------------
 class MemoryManager:
-    def __init__(self, user_id: str, base_folder="sessions", max_recent=5):
+    def __init__(self, user_id: str, base_folder="sessions", max_recent=5, storage=SESSION_STORAGE,
+                 background=PACK_IN_BACKGROUND):
         self.user_id = user_id
         self.base_folder = Path(base_folder)
         self.base_folder.mkdir(exist_ok=True)
-        self.save_path = self.base_folder / f"user_{user_id}.json"
         self.max_recent = max_recent
+        self.store = make_store(storage, user_id, self.base_folder)  # "journal" appends O(1) records per write
+        self.background = background
+        self._lock = threading.RLock()  # guards session dicts + store writes against the pack worker
+        self._detectors = {}            # session_id -> RepeatDetector over that session's recent Q/A pairs
+        self.packed_index = PackedIndex(user_id, self.base_folder)  # packed summaries of all sessions
+        self._packed_index_ready = False
+        self._index_lock = threading.Lock()
         self.sessions = {}
         self.load()
 
@@ -63,63 +175,189 @@ class MemoryManager:
     # Load / Save
     # ----------------------------
     def load(self):
-        if self.save_path.exists():
-            with open(self.save_path, "r", encoding="utf-8") as f:
-                self.sessions = json.load(f)
-        else:
-            self.sessions = {}
+        # Lazy backends (sqlite) return {} here; sessions are fetched by _session() on first use
+        self.sessions = self.store.load()
+
+    def _session(self, session_id: str) -> dict:
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.store.load_session(session_id)
+            if session is None:
+                raise KeyError(session_id)
+            self.sessions[session_id] = session
+        return session
+
+    def session_ids(self) -> List[str]:
+        return self.store.session_ids()
 
     def save(self):
-        with open(self.save_path, "w", encoding="utf-8") as f:
-            json.dump(self.sessions, f, indent=2, ensure_ascii=False)
-            
+        with stage("session_save"):
+            self.store.save()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait for this manager's background pack jobs; call before shutdown."""
+        if not self.background:
+            return True
+        keys = {(id(self), sid) for sid in list(self.sessions)}
+        return get_pack_worker().flush(timeout, keys)
+
+    def close(self, timeout: float = None):
+        self.flush(timeout)
+        with self._lock:
+            self.store.close()
+
     # ----------------------------
     # Create new session
     # ----------------------------
     def create_session(self, user_id: str, user_name: str = None) -> str:
         session_id = str(uuid.uuid4())
-        self.sessions[session_id] = {
-            "user_id": user_id,
-            "user_name": user_name,  # ← NEW FIELD
-            "created_at": datetime.now().isoformat(),
-            "recent": [],
-            "packed": [],
-        }
-        self.save()
+        with self._lock:
+            self.sessions[session_id] = {
+                "user_id": user_id,
+                "user_name": user_name,  # ← NEW FIELD
+                "created_at": datetime.now().isoformat(),
+                "recent": [],
+                "packed": [],
+            }
+            self.store.create_session(session_id, self.sessions[session_id])
         return session_id
 
     # ----------------------------
     # Add new message
     # ----------------------------
     def add_message(self, session_id: str, role: str, content: str):
-        session = self.sessions[session_id]
-        session["recent"].append({"role": role, "content": content})
+        with stage("memory_add"), self._lock:
+            session = self._session(session_id)
+            msg = {"role": role, "content": content}
+            session["recent"].append(msg)
+            self.store.append_message(session_id, msg)
+            detector = self._detectors.get(session_id)
+            if detector is not None and role == "assistant" and len(session["recent"]) > 1 \
+                    and session["recent"][-2]["role"] == "user":
+                detector.add(session["recent"][-2]["content"], content)
+            over_limit = len(session["recent"]) > self.max_recent
 
-        # If recent exceeds max_recent, pack older messages
-        if len(session["recent"]) > self.max_recent:
-            self._pack_old_messages(session)
+        # If recent exceeds max_recent, pack older messages (off the request path when background)
+        if over_limit:
+            if self.background:
+                get_pack_worker().submit((id(self), session_id), lambda: self._pack_old_messages(session_id))
+            else:
+                self._pack_old_messages(session_id)
 
-        self.save()
+    # ----------------------------
+    # Earlier sessions (history pagination)
+    # ----------------------------
+    def earlier_sessions(self, exclude_session_id: str, cursor: int = 0, limit: int = 1) -> Tuple[List[dict], int]:
+        """
+        Up to limit of the user's previous sessions, newest first, starting at cursor and
+        skipping sessions without a single question. Returns ([{session_id, created_at,
+        packed, recent}], next cursor or None when exhausted). Sessions are read from the
+        store on demand and not kept in memory.
+        """
+        ids = [sid for sid in reversed(self.session_ids()) if sid != exclude_session_id]
+        page = []
+        while cursor < len(ids) and len(page) < limit:
+            sid = ids[cursor]
+            cursor += 1
+            with self._lock:
+                session = self.sessions.get(sid) or self.store.load_session(sid)
+            if not session or not (session["packed"] or any(m["role"] == "user" for m in session["recent"])):
+                continue
+            page.append({
+                "session_id": sid,
+                "created_at": session.get("created_at"),
+                "packed": [b["summary"] for b in session["packed"]],
+                "recent": list(session["recent"]),
+            })
+        return page, (cursor if cursor < len(ids) else None)
 
     # ----------------------------
     # Check for recent repetition
     # ----------------------------
+    def _detector(self, session_id: str) -> RepeatDetector:
+        detector = self._detectors.get(session_id)
+        if detector is None:
+            detector = RepeatDetector()
+            recent = self._session(session_id)["recent"]
+            for q, a in zip(recent, recent[1:]):
+                if q["role"] == "user" and a["role"] == "assistant":
+                    detector.add(q["content"], a["content"])
+            self._detectors[session_id] = detector
+        return detector
+
+    def match_recent(self, session_id: str, query: str) -> Tuple[str, float]:
+        """Closest earlier question in the recent window: (answer that followed it, similarity 0..1)."""
+        with self._lock:
+            return self._detector(session_id).lookup(query)
+
     def find_recent_match(self, session_id: str, query: str, threshold=0.85) -> Tuple[bool, str]:
-        session = self.sessions[session_id]
-        for msg in reversed(session["recent"]):
-            if msg["role"] == "user":
-                similarity = SequenceMatcher(None, query.lower(), msg["content"].lower()).ratio()
-                if similarity >= threshold:
-                    idx = session["recent"].index(msg)
-                    if idx + 1 < len(session["recent"]) and session["recent"][idx + 1]["role"] == "assistant":
-                        return True, session["recent"][idx + 1]["content"]
+        answer, score = self.match_recent(session_id, query)
+        if answer is not None and score >= threshold:
+            return True, answer
         return False, None
 
     # ----------------------------
     # Search packed summaries for related info
     # ----------------------------
-    def search_packed(self, session_id: str, query: str) -> Tuple[bool, str]:
-        session = self.sessions[session_id]
+    def packed_summaries(self, session_id: str) -> List[str]:
+        """This session's packed summaries, newest first."""
+        with self._lock:
+            return [b["summary"] for b in reversed(self._session(session_id)["packed"])]
+
+    def _ensure_packed_index(self):
+        """
+        Load the user's packed-summary index and embed any stored packed summary it is
+        missing: all of them the first time, later only those packed while no process
+        had the index loaded (or lost to an interrupted append).
+        """
+        with self._index_lock:
+            if self._packed_index_ready:
+                return
+            self.packed_index.load()
+            missing = {}
+            for sid, timestamp in self.store.packed_keys():
+                if not self.packed_index.has(sid, timestamp):
+                    missing.setdefault(sid, set()).add(timestamp)
+            items = []
+            for sid, stamps in missing.items():  # only sessions with unindexed blocks are read in full
+                session = self.sessions.get(sid) or self.store.load_session(sid)
+                if session:
+                    items.extend((sid, block) for block in session["packed"] if block["timestamp"] in stamps)
+            vectors = embed_texts(get_embed_client(), [b["summary"] for _, b in items]) if items else []
+            self.packed_index.add_many([(sid, b, v) for (sid, b), v in zip(items, vectors)])
+            self.packed_index.meta_path.parent.mkdir(parents=True, exist_ok=True)
+            self.packed_index.meta_path.touch()
+            self._packed_index_ready = True
+
+    def _index_packed(self, session_id: str, block: dict):
+        try:
+            self._ensure_packed_index()  # the block is already in the store, so a first load embeds it
+            with self._index_lock:
+                if self.packed_index.has(session_id, block["timestamp"]):
+                    return
+                self.packed_index.add(session_id, block, embed_text(get_embed_client(), block["summary"]))
+        except Exception as e:
+            print(f"[Warning] Could not index packed summary: {e}")
+
+    def search_packed_all(self, query: str, k: int = 3, query_embedding=None) -> List[Tuple[dict, float]]:
+        """Top-k packed summaries from all of the user's sessions: [({session_id, summary, timestamp}, cosine)]."""
+        self._ensure_packed_index()
+        if query_embedding is None:
+            query_embedding = embed_text(get_embed_client(), query)
+        return self.packed_index.search(query_embedding, k)
+
+    def search_packed(self, session_id: str, query: str, query_embedding=None) -> Tuple[bool, str]:
+        try:
+            hits = self.search_packed_all(query, k=1, query_embedding=query_embedding)
+        except Exception as e:
+            print(f"[Warning] Packed index search failed, falling back to text match: {e}")
+            return self._search_packed_text(session_id, query)
+        if hits and hits[0][1] >= PACKED_MATCH_THRESHOLD:
+            return True, hits[0][0]["summary"]
+        return False, None
+
+    def _search_packed_text(self, session_id: str, query: str) -> Tuple[bool, str]:
+        session = self._session(session_id)
         best_match = None
         best_score = 0
         for block in session["packed"]:
@@ -134,22 +372,33 @@ class MemoryManager:
     # ----------------------------
     # Internal: summarize older messages
     # ----------------------------
-    def _pack_old_messages(self, session):
+    def _pack_old_messages(self, session_id: str):
         # Keep last self.max_recent messages; summarize the rest
-        if len(session["recent"]) <= self.max_recent:
-            return
+        with self._lock:
+            session = self._session(session_id)
+            if len(session["recent"]) <= self.max_recent:
+                return
+            to_summarize = session["recent"][:-self.max_recent]
 
-        to_summarize = session["recent"][:-self.max_recent]
+        # Summarize without holding the lock so new messages can keep arriving
         text = "\n".join([f"{m['role']}: {m['content']}" for m in to_summarize])
         summary = summarize_text(text)
 
-        session["packed"].append({
+        block = {
             "summary": summary,
             "timestamp": datetime.now().isoformat(),
-        })
-
-        # Keep only last self.max_recent messages
-        session["recent"] = session["recent"][-self.max_recent:]
+        }
+        n = len(to_summarize)
+        with self._lock:
+            # Only one pack job runs per session, so the summarized messages are still
+            # the head of "recent"; commit the summary and the trim together.
+            if len(session["recent"]) < n or any(a is not b for a, b in zip(session["recent"], to_summarize)):
+                return
+            session["packed"].append(block)
+            session["recent"] = session["recent"][n:]
+            self.store.commit_pack(session_id, block, n)
+            self._detectors.pop(session_id, None)  # rebuilt from the trimmed window on next lookup
+        self._index_packed(session_id, block)
 
 
 # ---------------- Example usage ----------------
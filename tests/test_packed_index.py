@@ -0,0 +1,64 @@
+import threading
+
+import numpy as np
+
+from utils.packed_index import PackedIndex
+
+DIM = 16
+
+
+def vector_for(name: str) -> np.ndarray:
+    v = np.random.default_rng(abs(hash(name)) % 2**32).standard_normal(DIM).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+def add_rows(index: PackedIndex, session_id: str, n: int):
+    for i in range(n):
+        block = {"summary": f"{session_id}-{i}", "timestamp": str(i)}
+        index.add(session_id, block, vector_for(block["summary"]))
+
+
+def test_concurrent_instances_keep_vectors_aligned(tmp_path):
+    # two MemoryManagers of the same user (two tabs) each own an index over the same files
+    writers = [PackedIndex("u", tmp_path), PackedIndex("u", tmp_path)]
+    threads = [threading.Thread(target=add_rows, args=(index, f"s{k}", 400)) for k, index in enumerate(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    reloaded = PackedIndex("u", tmp_path)
+    reloaded.load()
+    assert len(reloaded.entries) == 800
+    for entry, row in zip(reloaded.entries, reloaded.matrix):
+        assert np.allclose(row, vector_for(entry["summary"]), atol=1e-6), entry["summary"]
+
+
+def test_instance_picks_up_rows_added_by_another(tmp_path):
+    first, second = PackedIndex("u", tmp_path), PackedIndex("u", tmp_path)
+    first.load()
+    second.load()
+    add_rows(first, "a", 3)
+    add_rows(second, "a", 3)   # same blocks: skipped once second has caught up
+    add_rows(second, "b", 2)
+
+    reloaded = PackedIndex("u", tmp_path)
+    reloaded.load()
+    assert [e["summary"] for e in reloaded.entries] == ["a-0", "a-1", "a-2", "b-0", "b-1"]
+
+
+def test_torn_append_is_cut_back_on_load(tmp_path):
+    index = PackedIndex("u", tmp_path)
+    add_rows(index, "s", 5)
+    with open(index.vec_path, "ab") as f:   # crash after the vector write, before the metadata
+        f.write(vector_for("lost").tobytes())
+    with open(index.meta_path, "ab") as f:
+        f.write(b'{"session_id": "s", "summ')
+
+    reloaded = PackedIndex("u", tmp_path)
+    reloaded.load()
+    add_rows(reloaded, "t", 1)
+    again = PackedIndex("u", tmp_path)
+    again.load()
+    assert [e["summary"] for e in again.entries] == ["s-0", "s-1", "s-2", "s-3", "s-4", "t-0"]
+    assert np.allclose(again.matrix[-1], vector_for("t-0"), atol=1e-6)
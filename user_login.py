@@ -1,44 +1,23 @@
 import streamlit as st
-import chromadb
 from pathlib import Path
 
+from utils.user_directory import UserDirectory, UserExistsError, UserIdExhaustedError
+
 # ---------------- CONFIG ----------------
 CHROMA_PATH = Path("db")
 USER_COLLECTION = "users"
-START_ID = 1000
-MAX_ID = 9999
 
-# ---------------- INIT CHROMA ----------------
+# ---------------- INIT USER DIRECTORY ----------------
 @st.cache_resource
-def get_user_collection():
-    client = chromadb.PersistentClient(path=str(CHROMA_PATH))
-    return client.get_or_create_collection(name="users")
-
-# ---------------- HELPERS ----------------
-def generate_user_id(collection) -> str:
-    all_data = collection.get(include=["metadatas"])
-    ids = []
-    if all_data and "metadatas" in all_data:
-        for meta in all_data["metadatas"]:
-            if isinstance(meta, dict) and "id" in meta:
-                try:
-                    ids.append(int(meta["id"]))
-                except Exception:
-                    pass
-    next_id = max(ids, default=START_ID - 1) + 1
-    if next_id > MAX_ID:
-        st.error("User ID limit reached.")
-        st.stop()
-    return f"{next_id:04d}"
-
-def get_user_by_name(collection, name: str):
-    results = collection.get(include=["metadatas"])
-    if not results or not results.get("metadatas"):
-        return None
-    for meta in results["metadatas"]:
-        if meta.get("name", "").strip().lower() == name.strip().lower():
-            return meta
-    return None
+def get_user_directory() -> UserDirectory:
+    directory = UserDirectory()
+    if len(directory) == 0 and CHROMA_PATH.exists():
+        # First run after the move off Chroma: copy existing profiles across once
+        import chromadb  # only needed for this one-time import, keep it off the login page's cold start
+        client = chromadb.PersistentClient(path=str(CHROMA_PATH))
+        collection = client.get_or_create_collection(name=USER_COLLECTION)
+        directory.import_profiles(collection.get(include=["metadatas"]).get("metadatas"))
+    return directory
 
 # ---------------- LOGIN PAGE ----------------
 def login_page():
@@ -54,13 +33,13 @@ def login_page():
     with login_placeholder.container():
         st.title("🔐 Welcome to Autism Support Assistant")
 
-        collection = get_user_collection()
+        directory = get_user_directory()
         mode = st.radio("Choose an option:", ["Log in (Existing User)", "Register (New User)"], horizontal=True)
 
         if mode == "Log in (Existing User)":
             name = st.text_input("Enter your name to continue:", key="login_name")
             if name and st.session_state.get("login_trigger", False):
-                user_data = get_user_by_name(collection, name)
+                user_data = directory.get_by_name(name)
                 if not user_data:
                     st.error("User not found. Please register as a new user.")
                     st.session_state["login_trigger"] = False
@@ -82,25 +61,16 @@ def login_page():
             has_autistic_child = st.toggle("Have Autistic Child?", value=True)
 
             if name and st.session_state.get("register_trigger", False):
-                existing = get_user_by_name(collection, name)
-                if existing:
+                try:
+                    user_metadata = directory.register(name, int(age), 0 if has_autistic_child else 1)
+                except UserExistsError:
                     st.error("This name already exists. Try logging in instead.")
                     st.session_state["register_trigger"] = False
                     st.stop()
-
-                user_id = generate_user_id(collection)
-                user_metadata = {
-                    "id": user_id,
-                    "name": name.strip(),
-                    "age": int(age),
-                    "has_autistic_child": 0 if has_autistic_child else 1,
-                }
-
-                collection.add(
-                    ids=[user_id],
-                    documents=["user_profile"],
-                    metadatas=[user_metadata],
-                )
+                except UserIdExhaustedError:
+                    st.error("User ID limit reached.")
+                    st.stop()
+                user_id = user_metadata["id"]
 
                 st.success(f"Registration successful! Welcome {name}. Your User ID: {user_id}")
                 st.session_state["user_data"] = user_metadata
@@ -0,0 +1,168 @@
+"""
+Cross-user semantic answer cache.
+
+Answers are keyed by the neighbourhood of the query embedding, the reply
+language and the KB build version. fill_db.py bumps the KB version whenever
+it changes the collection, and entries from any other version are purged on
+the next lookup made with the version currently on disk. Entries older than
+ANSWER_CACHE_TTL are never served. Only answers that depend on the question
+alone (no personal history or memory in the prompt) should be stored.
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+CHROMA_PATH = Path(os.getenv("CHROMA_PATH", "db"))
+KB_VERSION_PATH = CHROMA_PATH / "kb_version.json"
+ANSWER_CACHE_PATH = Path(os.getenv("ANSWER_CACHE_PATH", "cache/answers.sqlite3"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))  # cosine to a cached question
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))   # seconds
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+
+
+# ---------------- KB Version ----------------
+def read_kb_version() -> str:
+    if KB_VERSION_PATH.exists():
+        with open(KB_VERSION_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)["version"]
+    return "initial"
+
+def bump_kb_version() -> str:
+    """Record that the collection changed; called by fill_db.py after every sync that wrote anything."""
+    version = uuid.uuid4().hex
+    KB_VERSION_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = KB_VERSION_PATH.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": version, "updated_at": datetime.now().isoformat()}, f)
+    os.replace(tmp, KB_VERSION_PATH)
+    return version
+
+
+# ---------------- Cache ----------------
+class AnswerCache:
+    """
+    SQLite-backed store with an in-memory matrix of normalized question embeddings
+    per (language, KB version). The matrix is reloaded whenever another process
+    commits to the database (PRAGMA data_version), so all workers share hits.
+    """
+
+    def __init__(self, path: Path = ANSWER_CACHE_PATH, threshold: float = ANSWER_CACHE_THRESHOLD,
+                 ttl: float = ANSWER_CACHE_TTL, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " lang TEXT NOT NULL, kb_version TEXT NOT NULL,"
+            " question TEXT NOT NULL, answer TEXT NOT NULL, sources TEXT NOT NULL,"
+            " vec BLOB NOT NULL, created_at REAL NOT NULL, last_hit REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_scope ON answers(kb_version, lang)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_last_hit ON answers(last_hit)")
+        self._conn.commit()
+        self._views = {}          # (lang, kb_version) -> (ids, created_at, matrix)
+        self._data_version = None
+        self._live_version = None
+
+    def _view(self, lang: str, kb_version: str):
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self._views.clear()
+            self._data_version = data_version
+        key = (lang, kb_version)
+        if key not in self._views:
+            rows = self._conn.execute(
+                "SELECT id, created_at, vec FROM answers WHERE kb_version = ? AND lang = ? AND created_at >= ?",
+                (kb_version, lang, time.time() - self.ttl),
+            ).fetchall()
+            ids = [r[0] for r in rows]
+            created = np.array([r[1] for r in rows], dtype=np.float64)
+            matrix = np.vstack([np.frombuffer(r[2], dtype=np.float32) for r in rows]) if rows else None
+            self._views[key] = (ids, created, matrix)
+        return self._views[key]
+
+    def lookup(self, query_embedding, lang: str, kb_version: str) -> Optional[dict]:
+        """Return {"answer", "sources", "question", "score"} for a cached near-identical question, else None."""
+        q = np.asarray(query_embedding, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1.0)
+        with self._lock:
+            self._purge_other_versions(kb_version)
+            ids, created, matrix = self._view(lang, kb_version)
+            if matrix is None:
+                self.misses += 1
+                return None
+            # the view outlives the TTL when nothing else commits, so expiry is checked per lookup
+            scores = np.where(created >= time.time() - self.ttl, matrix @ q, -np.inf)
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            row = self._conn.execute(
+                "SELECT question, answer, sources FROM answers WHERE id = ?", (ids[best],)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE answers SET last_hit = ?, hits = hits + 1 WHERE id = ?", (time.time(), ids[best])
+            )
+            self._conn.commit()
+            self.hits += 1
+        return {"question": row[0], "answer": row[1], "sources": json.loads(row[2]), "score": float(scores[best])}
+
+    def store(self, question: str, query_embedding, lang: str, kb_version: str, answer: str, sources: List[dict]):
+        vec = np.asarray(query_embedding, dtype=np.float32)
+        vec = vec / (np.linalg.norm(vec) or 1.0)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO answers (lang, kb_version, question, answer, sources, vec, created_at, last_hit)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (lang, kb_version, question, answer, json.dumps(sources, ensure_ascii=False), vec.tobytes(), now, now),
+            )
+            self._conn.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl,))
+            count = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_hit ASC LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self._conn.commit()
+            self._views.clear()
+
+    def _purge_other_versions(self, kb_version: str):
+        if kb_version == self._live_version:
+            return
+        if kb_version != read_kb_version():
+            return  # a turn planned before fill_db bumped the version must not wipe the new entries
+        self._live_version = kb_version
+        self._conn.execute("DELETE FROM answers WHERE kb_version != ?", (kb_version,))
+        self._conn.commit()
+        self._views.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_answer_cache() -> AnswerCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnswerCache()
+        return _cache
@@ -0,0 +1,114 @@
+"""
+BM25 lexical index over the KB chunks, built by fill_db.py next to the Chroma
+collection and keyed by the same chunk IDs.
+
+Postings are stored CSR-style in one .npz (term offsets, doc indices and the
+precomputed per-posting BM25 weight), so a query is a handful of vectorized
+adds and an argpartition, well under a millisecond for this corpus size.
+"""
+import os
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+from utils.ranking import top_k
+
+CHROMA_PATH = Path(os.getenv("CHROMA_PATH", "db"))
+BM25_INDEX_PATH = Path(os.getenv("BM25_INDEX_PATH", str(CHROMA_PATH / "bm25_index.npz")))
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Romanized Lebanese writes some letters as digits (3 = ع, 7 = ح, 2 = ء), so digits stay inside tokens
+_TOKEN = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he her his how i if in into is it its my of on or "
+    "our she so that the their them they this to was we what when where which who why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN.findall(text.casefold()) if len(t) > 1 and t not in STOPWORDS]
+
+
+class BM25Index:
+    def __init__(self, ids: np.ndarray, terms: dict, offsets: np.ndarray, postings: np.ndarray, weights: np.ndarray):
+        self.ids = ids
+        self.terms = terms          # term -> row in offsets
+        self.offsets = offsets
+        self.postings = postings
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, records: Iterable[Tuple[str, str]]) -> "BM25Index":
+        """Build from (chunk id, text) pairs."""
+        ids, doc_terms = [], []
+        for cid, text in records:
+            ids.append(cid)
+            doc_terms.append(Counter(tokenize(text)))
+        n_docs = len(ids)
+        lengths = np.array([sum(c.values()) for c in doc_terms], dtype=np.float32)
+        avgdl = float(lengths.mean()) if n_docs else 1.0
+
+        by_term = {}
+        for doc, counts in enumerate(doc_terms):
+            for term, tf in counts.items():
+                by_term.setdefault(term, []).append((doc, tf))
+
+        vocab = sorted(by_term)
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        postings, weights = [], []
+        for row, term in enumerate(vocab):
+            plist = by_term[term]
+            docs = np.array([d for d, _ in plist], dtype=np.int32)
+            tfs = np.array([tf for _, tf in plist], dtype=np.float32)
+            idf = np.log(1.0 + (n_docs - len(plist) + 0.5) / (len(plist) + 0.5))
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * lengths[docs] / max(avgdl, 1e-9))
+            postings.append(docs)
+            weights.append((idf * tfs * (BM25_K1 + 1.0) / (tfs + norm)).astype(np.float32))
+            offsets[row + 1] = offsets[row] + len(plist)
+
+        return cls(
+            np.array(ids, dtype=str),
+            {t: i for i, t in enumerate(vocab)},
+            offsets,
+            np.concatenate(postings) if postings else np.zeros(0, dtype=np.int32),
+            np.concatenate(weights) if weights else np.zeros(0, dtype=np.float32),
+        )
+
+    def save(self, path: Path = BM25_INDEX_PATH):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.stem + ".tmp.npz")
+        np.savez(tmp, ids=self.ids, vocab=np.array(sorted(self.terms, key=self.terms.get), dtype=str),
+                 offsets=self.offsets, postings=self.postings, weights=self.weights)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path = BM25_INDEX_PATH):
+        path = Path(path)
+        if not path.exists():
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            vocab = data["vocab"]
+            return cls(data["ids"], {t: i for i, t in enumerate(vocab.tolist())},
+                       data["offsets"], data["postings"], data["weights"])
+
+    def search(self, query: str, k: int = 12) -> List[Tuple[str, float]]:
+        """Top-k (chunk id, BM25 score) pairs with a positive score, best first."""
+        if not len(self.ids):
+            return []
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            row = self.terms.get(term)
+            if row is None:
+                continue
+            lo, hi = self.offsets[row], self.offsets[row + 1]
+            scores[self.postings[lo:hi]] += self.weights[lo:hi]
+        top = top_k(scores, k)
+        return [(str(self.ids[i]), float(scores[i])) for i in top if scores[i] > 0]
@@ -0,0 +1,86 @@
+"""
+Token-budgeted prompt assembly for the chat turn.
+
+The budget is filled in priority order:
+    1. system prompt
+    2. current question + KB excerpts
+    3. most recent conversation turns (newest first, stopping at the first that doesn't fit)
+    4. packed summaries (most relevant first)
+so the prompt size stays constant however long the session gets. Callers cut
+the question and size the KB excerpts so that 1 and 2 fit (AnswerEngine.
+question_budget and kb_budget); build_messages raises only if the system prompt
+alone is configured over the budget, instead of sending an oversized prompt.
+"""
+import os
+from functools import lru_cache
+from typing import Dict, List
+
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o-mini")
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+MESSAGE_OVERHEAD = 4  # role/separator tokens the chat format adds per message
+
+try:
+    import tiktoken
+    try:
+        _ENCODING = tiktoken.encoding_for_model(CHAT_MODEL)
+    except KeyError:
+        _ENCODING = tiktoken.get_encoding("o200k_base")
+except ImportError:  # fall back to a ~4 chars/token estimate
+    _ENCODING = None
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """Token count of text with the local tokenizer; cached, so replayed history is only encoded once."""
+    if _ENCODING is None:
+        return len(text) // 4 + 1
+    return len(_ENCODING.encode(text, disallowed_special=()))
+
+def message_tokens(message: Dict) -> int:
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+def truncate_tokens(text: str, limit: int) -> str:
+    """The first `limit` tokens of text (or the whole text if it is shorter)."""
+    if count_tokens(text) <= limit:
+        return text
+    if _ENCODING is None:
+        return text[:max(0, limit - 1) * 4]
+    return _ENCODING.decode(_ENCODING.encode(text, disallowed_special=())[:limit])
+
+
+def build_messages(system_prompt: str, question: str, history: List[Dict], summaries: List[str],
+                   budget: int = CONTEXT_TOKEN_BUDGET) -> List[Dict]:
+    """
+    history:   earlier {"role", "content"} turns, oldest first, without the current question
+    summaries: packed summaries, most relevant first
+    """
+    system = {"role": "system", "content": system_prompt}
+    current = {"role": "user", "content": question}
+    remaining = budget - message_tokens(system) - message_tokens(current)
+    if remaining < 0:
+        raise ValueError(
+            f"system prompt and question need {budget - remaining} tokens, over the {budget}-token context budget"
+        )
+
+    turns = []
+    for m in reversed(history):
+        cost = message_tokens(m)
+        if cost > remaining:
+            break
+        turns.append(m)
+        remaining -= cost
+    turns.reverse()
+
+    header = "Summaries of earlier conversations with this parent:"
+    kept, cost = [], count_tokens(header) + MESSAGE_OVERHEAD
+    for summary in summaries:
+        extra = count_tokens(summary) + 3  # "- " bullet and newline
+        if cost + extra > remaining:
+            break
+        kept.append(summary)
+        cost += extra
+
+    messages = [system]
+    if kept:
+        messages.append({"role": "system", "content": header + "\n" + "\n".join(f"- {s}" for s in kept)})
+    return messages + turns + [current]
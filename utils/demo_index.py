@@ -0,0 +1,114 @@
+"""
+Prebuilt embedding index for DEMO_RESPONSES keys.
+
+Build it as a deploy step, with the same EMBED_MODEL and API key as the app:
+    python -m utils.demo_index
+The artifact is not committed (it depends on the embedding model), so without
+that step the first cold start embeds every demo key before it can answer.
+
+The artifact is a pre-normalized float32 matrix (DEMO_INDEX_PATH, .npy) plus a
+JSON key index next to it. Both are written to temporary files and swapped in
+with os.replace, the JSON last, and the JSON records a checksum of the matrix,
+so a torn or interleaved write is rebuilt instead of being loaded. At startup
+the app only loads those files; the index is rebuilt automatically (through
+the embedding cache) when the demo keys change.
+"""
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+if __name__ == "__main__":
+    # the build step: .env has to be loaded before EMBED_MODEL and DEMO_INDEX_PATH are read below,
+    # or the artifact gets a different fingerprint or path than the app looks for
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=Path(__file__).parent.parent / ".env", override=True)
+
+import numpy as np
+
+from utils.embeddings import EMBED_MODEL, embed_texts
+from utils.ranking import top_k
+
+DEMO_INDEX_PATH = Path(os.getenv("DEMO_INDEX_PATH", "assets/demo_index.npy"))
+
+
+def demo_fingerprint(responses: Dict, model: str = EMBED_MODEL) -> str:
+    """Hash of the model and the ordered demo keys; changes whenever a key is added, removed or edited."""
+    h = hashlib.sha256(model.encode("utf-8"))
+    for key in responses:
+        h.update(b"\0" + key.encode("utf-8"))
+    return h.hexdigest()
+
+
+class DemoIndex:
+    """Row-normalized key matrix; a query is scored with one matrix-vector product."""
+
+    def __init__(self, keys: List[str], matrix: np.ndarray, fingerprint: str):
+        self.keys = keys
+        self.matrix = matrix
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.keys)
+
+    def match(self, query_embedding, k: int = 1) -> List[Tuple[str, float]]:
+        """Return the top-k (key, cosine similarity) pairs, best first."""
+        if not self.keys:
+            return []
+        q = np.asarray(query_embedding, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1.0)
+        scores = self.matrix @ q
+        top = top_k(scores, k)
+        return [(self.keys[i], float(scores[i])) for i in top]
+
+
+def _meta_path(path: Path) -> Path:
+    return path.with_suffix(".json")
+
+def _checksum(matrix: np.ndarray) -> str:
+    return hashlib.sha256(np.ascontiguousarray(matrix).tobytes()).hexdigest()
+
+def _replace(path: Path, write):
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+def build_demo_index(client, responses: Dict, path: Path = DEMO_INDEX_PATH, model: str = EMBED_MODEL) -> DemoIndex:
+    keys = list(responses.keys())
+    vectors = embed_texts(client, keys, model) if keys else []
+    matrix = np.vstack(vectors).astype(np.float32) if keys else np.zeros((0, 0), dtype=np.float32)
+    if keys:
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+    fingerprint = demo_fingerprint(responses, model)
+    meta = {"model": model, "fingerprint": fingerprint, "keys": keys, "sha256": _checksum(matrix)}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _replace(path, lambda f: np.save(f, matrix))
+    _replace(_meta_path(path), lambda f: f.write(json.dumps(meta, ensure_ascii=False).encode("utf-8")))
+    return DemoIndex(keys, matrix, fingerprint)
+
+def load_demo_index(client, responses: Dict, path: Path = DEMO_INDEX_PATH, model: str = EMBED_MODEL) -> DemoIndex:
+    """Load the artifact if it matches the current demo keys, otherwise rebuild it."""
+    fingerprint = demo_fingerprint(responses, model)
+    meta_path = _meta_path(path)
+    if path.exists() and meta_path.exists():
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("fingerprint") == fingerprint:
+                matrix = np.load(path)
+                if meta.get("sha256") == _checksum(matrix):
+                    return DemoIndex(meta["keys"], matrix, fingerprint)
+        except (OSError, ValueError) as e:
+            print(f"[Warning] Demo index unreadable, rebuilding: {e}")
+    return build_demo_index(client, responses, path, model)
+
+
+if __name__ == "__main__":
+    from utils.openai_client import get_openai_client
+    from demo_answers import DEMO_RESPONSES
+
+    index = build_demo_index(get_openai_client(), DEMO_RESPONSES)
+    print(f"✅ Built demo index with {len(index)} keys → {DEMO_INDEX_PATH}")
@@ -1,24 +1,104 @@
-LEB_PATTERNS = {
-    "keef": "how",
-    "kifak": "how are you",
-    "nharak": "your day",
-    "lyom": "today",
-    "mnee7": "good",
-    "shou": "what",
-    "akhbarak": "your news",
-    "habib": "dear",
-    "sah": "right"
-}
+"""
+Lebanese romanized chat (Arabizi) detection and normalization.
+
+The lexicon lives in assets/leb_lexicon.json (romanized word or phrase ->
+English) so it can grow without code changes. It is compiled once into a
+single case-insensitive regex built from a character trie, anchored on word
+boundaries, so one scan of the text both detects and rewrites dialect tokens
+("sah" matches "sah" but not "Sahara") however large the lexicon gets.
+"""
+import os
+import re
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Tuple
+
+LEB_LEXICON_PATH = Path(os.getenv("LEB_LEXICON_PATH", "assets/leb_lexicon.json"))
+# one stray hit in an English sentence is not enough: the text is Lebanese when lexicon
+# matches cover this share of its words, or when there are at least this many of them
+LEB_MIN_CONFIDENCE = float(os.getenv("LEB_MIN_CONFIDENCE", "0.25"))
+LEB_MIN_MATCHES = int(os.getenv("LEB_MIN_MATCHES", "2"))
+
+# Romanized Lebanese writes some letters as digits (3 = ع, 7 = ح, 2 = ء), so digits count as word characters
+_WORD = re.compile(r"\w+")
+
+
+@dataclass(frozen=True)
+class DialectResult:
+    text: str            # input with dialect tokens replaced by English
+    is_leb: bool
+    confidence: float    # share of the input's words covered by lexicon matches
+    matches: Tuple[str, ...]
+
+
+def load_lexicon(path: Path = LEB_LEXICON_PATH) -> Dict[str, str]:
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    return {" ".join(k.casefold().split()): v for k, v in raw.items() if k.strip()}
+
+
+def _trie_regex(words) -> str:
+    """Alternation of words as a prefix trie, so matching cost depends on word length, not lexicon size."""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def walk(node) -> str:
+        end = "" in node
+        branches = [re.escape(ch) + walk(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return "(?:" + body + ")?" if end else body
+
+    return walk(trie)
+
+
+class DialectNormalizer:
+    def __init__(self, lexicon: Dict[str, str]):
+        self.lexicon = lexicon
+        # phrases may be written with any run of whitespace between words
+        pattern = _trie_regex(lexicon).replace(r"\ ", r"\s+")
+        self._regex = re.compile(r"(?<!\w)(?:" + pattern + r")(?!\w)", re.IGNORECASE) if lexicon else None
+
+    def analyze(self, text: str) -> DialectResult:
+        if self._regex is None:
+            return DialectResult(text, False, 0.0, ())
+        matches, covered = [], [0]
+
+        def replace(m):
+            found = m.group(0)
+            key = " ".join(found.casefold().split())
+            matches.append(key)
+            covered[0] += len(key.split())
+            repl = self.lexicon[key]
+            return repl[:1].upper() + repl[1:] if found[:1].isupper() else repl
+
+        out = self._regex.sub(replace, text)
+        total = len(_WORD.findall(text))
+        confidence = covered[0] / total if total else 0.0
+        is_leb = bool(matches) and (confidence >= LEB_MIN_CONFIDENCE or len(matches) >= LEB_MIN_MATCHES)
+        return DialectResult(out, is_leb, confidence, tuple(matches))
+
+
+@lru_cache(maxsize=1)
+def get_normalizer() -> DialectNormalizer:
+    return DialectNormalizer(load_lexicon())
+
+
+def analyze(text: str) -> DialectResult:
+    return get_normalizer().analyze(text)
 
 def normalize_for_embedding(text: str) -> str:
     """
     Replace Lebanese romanized tokens with English so embeddings work better.
     """
-    out = text
-    for pat, repl in LEB_PATTERNS.items():
-        out = out.replace(pat, repl).replace(pat.capitalize(), repl)
-    return out
+    return analyze(text).text
 
 def detect_leb_chat(text: str) -> bool:
-    low = text.lower()
-    return any(tok in low for tok in LEB_PATTERNS.keys())
+    return analyze(text).is_leb
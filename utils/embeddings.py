@@ -0,0 +1,167 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+from openai import BadRequestError
+
+from utils.metrics import stage, record_usage, record_cache
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+EMBED_CACHE_PATH = Path(os.getenv("EMBED_CACHE_PATH", "cache/embeddings.sqlite3"))
+# ~6 KB per entry for 1536-dim float32 vectors, so 100k entries is roughly 600 MB on disk
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "100000"))
+
+_WS = re.compile(r"\s+")
+
+
+# ---------------- Keys ----------------
+def normalize_text(text: str) -> str:
+    """
+    Canonical form used for cache keys and sent to the API: NFC, whitespace collapsed.
+    Only changes that can't alter the embedding are made, so every text sharing a key
+    gets the vector of that exact string.
+    """
+    return _WS.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+# ---------------- Cache ----------------
+class EmbeddingCache:
+    """
+    On-disk embedding cache keyed by sha256(model + normalized text).
+    Vectors are stored as raw float32 blobs in SQLite; once the cache holds more
+    than max_entries, the least recently used tenth is evicted.
+    """
+
+    def __init__(self, path: Path = EMBED_CACHE_PATH, max_entries: int = EMBED_CACHE_MAX_ENTRIES):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, dim INTEGER NOT NULL, vec BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        if not keys:
+            return found
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k in found]
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, vec in items.items():
+            vec = np.asarray(vec, dtype=np.float32)
+            rows.append((key, vec.shape[0], vec.tobytes(), now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, dim, vec, last_used) VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+            self._evict()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        excess = count - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)", (excess,)
+        )
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Process-wide cache instance shared by chat, memory and ingest."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
+
+
+# ---------------- Embedding ----------------
+def embed_batch(client, texts: List[str], model: str = EMBED_MODEL) -> List[List[float]]:
+    """Embed a list of texts in one request; split in half and retry if the request is rejected."""
+    try:
+        with stage("embed_api"):
+            resp = client.embeddings.create(model=model, input=texts)
+    except BadRequestError as e:
+        if len(texts) == 1:
+            raise
+        mid = len(texts) // 2
+        print(f"\n[Warning] Embedding batch of {len(texts)} rejected ({e.__class__.__name__}), splitting.")
+        return embed_batch(client, texts[:mid], model) + embed_batch(client, texts[mid:], model)
+    record_usage(model, resp.usage)
+    return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+def embed_texts(client, texts: List[str], model: str = EMBED_MODEL, cache: EmbeddingCache = None) -> List[np.ndarray]:
+    """
+    Embed texts through the cache: only texts never seen before (after normalization)
+    are sent to the API, in a single request, and duplicates within the call are sent once.
+    """
+    if cache is None:
+        cache = get_embedding_cache()
+    keys = [cache_key(model, t) for t in texts]
+    found = cache.get_many(list(dict.fromkeys(keys)))
+
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in missing:
+            missing[key] = normalize_text(text) or text  # the API rejects an empty string
+    hits = sum(1 for k in keys if k in found)
+    cache.hits += hits
+    cache.misses += len(missing)
+    record_cache("embedding", hits, len(missing))
+
+    if missing:
+        vectors = embed_batch(client, list(missing.values()), model)
+        fresh = {k: np.asarray(v, dtype=np.float32) for k, v in zip(missing, vectors)}
+        cache.put_many(fresh)
+        found.update(fresh)
+    return [found[k] for k in keys]
+
+def embed_text(client, text: str, model: str = EMBED_MODEL) -> np.ndarray:
+    return embed_texts(client, [text], model)[0]
@@ -0,0 +1,137 @@
+"""
+CPU-only extractive summarizer for memory packing (SUMMARIZER_BACKEND=extractive).
+
+The packed transcript is split into sentences, each sentence becomes a TF-IDF
+vector, and sentences are scored by a blend of TextRank centrality (power
+iteration over the cosine-similarity graph) and similarity to the transcript's
+centroid. The parent's best-scoring sentence is always kept, since it names
+the topic; the rest are picked greedily, skipping near-duplicates, until the
+length budget is spent, and everything is returned in its original order.
+
+Romanized Lebanese is scored through the dialect lexicon (so "ibni" and "my
+son" count as the same term) while the summary keeps the parent's own words.
+No network, no model download; a pack takes a few milliseconds.
+"""
+import re
+from typing import List, Tuple
+
+import numpy as np
+
+from utils.bm25 import tokenize
+from utils.dialect import analyze as analyze_dialect
+
+MAX_CHARS = 400        # same size as the truncation fallback summaries used to get
+MAX_SENTENCES = 4
+MIN_SENTENCE_CHARS = 12
+MIN_SENTENCE_TERMS = 4   # drops fragments and bare headings
+DAMPING = 0.85
+CENTROID_WEIGHT = 0.5  # 0 = pure TextRank, 1 = pure centroid
+REDUNDANCY_SIM = 0.7   # skip a sentence this similar to one already chosen
+
+_TAG = re.compile(r"<br\s*/?>|</?(?:li|p|div|ul|ol)[^>]*>", re.IGNORECASE)
+_HTML = re.compile(r"<[^>]+>")
+_ROLE = re.compile(r"^(user|assistant):\s*", re.IGNORECASE)
+_BULLET = re.compile(r"^(?:[•*\-]|\d+[.)])\s*")  # "7ewel" is a word, "1." is numbering
+_SENTENCE = re.compile(r"(?<=[.!?؟])\s+")
+_ABBREVIATION = re.compile(r"(?:^|[\s.])(?:[A-Z][a-z]?|Mrs|Prof|vs|[a-z]\.[a-z])\.$")  # "Dr." "O.T." "e.g." end no sentence
+_DISCLAIMER = "⚠"  # "⚠️ Hayda kello irshad, mesh tashkhees." closes the answers; never summary material
+
+
+def _split_line(line: str) -> List[str]:
+    parts = []
+    for part in _SENTENCE.split(line):
+        if parts and _ABBREVIATION.search(parts[-1]):
+            parts[-1] += " " + part
+        else:
+            parts.append(part)
+    return parts
+
+
+def _strip_markup(line: str) -> str:
+    return _HTML.sub(" ", _TAG.sub("\n", line))
+
+
+def split_sentences(text: str) -> List[Tuple[str, str]]:
+    """(role, sentence) pairs of a "role: content" transcript, HTML and bullets stripped."""
+    sentences, role = [], "user"
+    for line in text.splitlines():
+        line = line.strip()
+        m = _ROLE.match(line)
+        if m:
+            role, line = m.group(1).lower(), line[m.end():]  # unlabelled lines continue the previous message
+        for part in (p for chunk in _strip_markup(line).split("\n") for p in _split_line(chunk)):
+            part = _BULLET.sub("", " ".join(part.split()))
+            if (len(part) >= MIN_SENTENCE_CHARS and not part.startswith(_DISCLAIMER)
+                    and len(tokenize(part)) >= MIN_SENTENCE_TERMS):
+                sentences.append((role, part))
+    return sentences
+
+
+def _tfidf(sentences: List[str]) -> np.ndarray:
+    docs = [tokenize(analyze_dialect(s).text) for s in sentences]
+    vocab = {}
+    for doc in docs:
+        for term in doc:
+            vocab.setdefault(term, len(vocab))
+    tf = np.zeros((len(docs), max(len(vocab), 1)), dtype=np.float32)
+    for i, doc in enumerate(docs):
+        for term in doc:
+            tf[i, vocab[term]] += 1.0
+    df = (tf > 0).sum(axis=0)
+    idf = np.log((1.0 + len(docs)) / (1.0 + df)) + 1.0
+    m = tf * idf
+    return m / np.maximum(np.linalg.norm(m, axis=1, keepdims=True), 1e-12)
+
+
+def _textrank(sim: np.ndarray, iterations: int = 50, tol: float = 1e-6) -> np.ndarray:
+    n = len(sim)
+    w = sim.copy()
+    np.fill_diagonal(w, 0.0)
+    out = w.sum(axis=1, keepdims=True)
+    w = np.divide(w, out, out=np.full_like(w, 1.0 / n), where=out > 0)  # isolated sentences link everywhere
+    scores = np.full(n, 1.0 / n, dtype=np.float32)
+    for _ in range(iterations):
+        nxt = (1 - DAMPING) / n + DAMPING * (w.T @ scores)
+        if np.abs(nxt - scores).sum() < tol:
+            return nxt
+        scores = nxt
+    return scores
+
+
+def _unit_range(x: np.ndarray) -> np.ndarray:
+    span = x.max() - x.min()
+    return (x - x.min()) / span if span > 0 else np.ones_like(x)
+
+
+def summarize(text: str, max_chars: int = MAX_CHARS, max_sentences: int = MAX_SENTENCES) -> str:
+    pairs = split_sentences(text)
+    sentences = [s for _, s in pairs]
+    if not sentences:  # only fragments: keep the words, drop labels and markup
+        plain = " ".join(_strip_markup(_ROLE.sub("", line.strip())) for line in text.splitlines())
+        return " ".join(plain.split())[:max_chars]
+    if len(sentences) == 1:
+        return sentences[0][:max_chars]
+
+    m = _tfidf(sentences)
+    sim = np.clip(m @ m.T, 0.0, 1.0)
+    centroid = m.mean(axis=0)
+    centroid /= max(float(np.linalg.norm(centroid)), 1e-12)
+    scores = (1 - CENTROID_WEIGHT) * _unit_range(_textrank(sim)) + CENTROID_WEIGHT * _unit_range(m @ centroid)
+
+    order = np.argsort(-scores)
+    from_user = [int(i) for i in order if pairs[i][0] == "user" and len(sentences[i]) < max_chars]
+    chosen = from_user[:1]
+    used = len(sentences[chosen[0]]) + 1 if chosen else 0
+    for i in order:
+        if len(chosen) >= max_sentences:
+            break
+        if i in chosen or any(sim[i, j] >= REDUNDANCY_SIM for j in chosen):
+            continue
+        cost = len(sentences[i]) + 1
+        if used + cost > max_chars:
+            continue  # a shorter, lower-ranked sentence may still fit
+        chosen.append(int(i))
+        used += cost
+    if not chosen:
+        return sentences[int(np.argmax(scores))][:max_chars]
+    return " ".join(sentences[i] for i in sorted(chosen))
@@ -0,0 +1,184 @@
+"""
+Image service for the [[image:tag]] visuals.
+
+assets/image_map.json is validated once at startup (tag format, file present,
+decodable). For every (source, width) a resized derivative is encoded once
+(WebP by default) and stored under IMAGE_CACHE_DIR, keyed by the source's
+sha256, so editing an image invalidates its derivatives automatically. The
+encoded bytes are then served from a size-bounded in-memory LRU, so redrawing
+the history hands Streamlit a few tens of KB instead of re-reading multi-MB PNGs.
+"""
+import os
+import io
+import re
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    from PIL import Image
+except ImportError:  # serve the original files, still through the byte cache
+    Image = None
+
+from utils.files import file_sha256
+
+IMAGE_MAP_PATH = Path(os.getenv("IMAGE_MAP_PATH", "assets/image_map.json"))
+IMAGE_CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR", "cache/images"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "webp").lower()  # webp | png
+IMAGE_DPR = float(os.getenv("IMAGE_DPR", "1"))            # derivative pixels per display pixel (2 for retina)
+IMAGE_LRU_BYTES = int(os.getenv("IMAGE_LRU_BYTES", str(32 * 1024 * 1024)))
+DEFAULT_WIDTH = 500
+
+TAG = re.compile(r"^[a-zA-Z0-9_\-]+$")  # same charset as the [[image:tag]] token in chat.py
+
+
+def load_image_map(path: Path = IMAGE_MAP_PATH) -> Tuple[Dict[str, Path], List[str]]:
+    """Valid {tag: path} entries and a list of problems with the rest."""
+    if not Path(path).exists():
+        return {}, [f"{path} not found"]
+    try:
+        raw = json.loads(Path(path).read_text(encoding="utf-8"))
+    except json.JSONDecodeError as e:
+        return {}, [f"{path}: invalid JSON ({e})"]
+    if not isinstance(raw, dict):
+        return {}, [f"{path}: expected an object of tag -> file"]
+
+    valid, problems = {}, []
+    for tag, file in raw.items():
+        if not TAG.match(tag):
+            problems.append(f"{tag!r}: tag can't be referenced as [[image:...]]")
+            continue
+        file = Path(file) if isinstance(file, str) else None
+        if file is None or not file.is_file():
+            problems.append(f"{tag!r}: missing file {file}")
+            continue
+        if Image is not None:
+            try:
+                with Image.open(file) as img:
+                    img.verify()
+            except Exception as e:
+                problems.append(f"{tag!r}: unreadable image {file} ({e.__class__.__name__})")
+                continue
+        valid[tag] = file
+    return valid, problems
+
+
+class ImageService:
+    def __init__(self, image_map: Dict[str, Path], cache_dir: Path = IMAGE_CACHE_DIR,
+                 fmt: str = IMAGE_FORMAT, max_bytes: int = IMAGE_LRU_BYTES, dpr: float = IMAGE_DPR):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.fmt = fmt if fmt in ("webp", "png") else "webp"
+        self.max_bytes = max_bytes
+        self.dpr = dpr
+        self.sources = {tag: (Path(p), file_sha256(p)) for tag, p in image_map.items()}
+        self._lru: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._build_locks: Dict[tuple, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, tag: str) -> bool:
+        return tag in self.sources
+
+    def __len__(self):
+        return len(self.sources)
+
+    @staticmethod
+    def caption(tag: str) -> str:
+        return tag.replace("_", " ").title()
+
+    def derivative_path(self, sha: str, width: int) -> Path:
+        return self.cache_dir / f"{sha[:24]}_{width}.{self.fmt}"
+
+    def get(self, tag: str, width: int = DEFAULT_WIDTH) -> Optional[bytes]:
+        """Encoded bytes of tag at display width, or None for an unknown tag."""
+        source = self.sources.get(tag)
+        if source is None:
+            return None
+        path, sha = source
+        key = (sha, width)
+        with self._lock:
+            data = self._lru.get(key)
+            if data is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        with build_lock:  # concurrent sessions redrawing the same image build it once
+            with self._lock:
+                data = self._lru.get(key)
+            if data is None:
+                data = self._load_or_build(path, sha, width)
+                self._remember(key, data)
+        return data
+
+    def _load_or_build(self, path: Path, sha: str, width: int) -> bytes:
+        if Image is None:
+            return path.read_bytes()
+        out = self.derivative_path(sha, width)
+        if out.exists():
+            return out.read_bytes()
+
+        with Image.open(path) as img:
+            img.load()
+            target = int(width * self.dpr)
+            if img.width > target:  # never upscale
+                img = img.resize((target, round(img.height * target / img.width)), Image.LANCZOS)
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA")
+            buf = io.BytesIO()
+            if self.fmt == "webp":
+                img.save(buf, format="WEBP", quality=85, method=4)
+            else:
+                img.save(buf, format="PNG", optimize=True)
+        data = buf.getvalue()
+
+        tmp = out.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, out)
+        return data
+
+    def _remember(self, key: tuple, data: bytes):
+        with self._lock:
+            if key in self._lru or len(data) > self.max_bytes:
+                return
+            self._lru[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._lru.popitem(last=False)
+                self._size -= len(evicted)
+
+    def warm(self, widths: Iterable[int] = (DEFAULT_WIDTH,)):
+        """Build (or load) every derivative up front, e.g. at startup or from a deploy step."""
+        for tag in self.sources:
+            for width in widths:
+                try:
+                    self.get(tag, width)
+                except Exception as e:
+                    print(f"[Warning] Could not prepare image {tag!r} at {width}px: {e}")
+
+
+_service = None
+_service_lock = threading.Lock()
+
+def get_image_service() -> ImageService:
+    global _service
+    with _service_lock:
+        if _service is None:
+            image_map, problems = load_image_map()
+            for problem in problems:
+                print(f"[Warning] image_map.json: {problem}")
+            _service = ImageService(image_map)
+        return _service
+
+
+if __name__ == "__main__":
+    service = get_image_service()
+    service.warm()
+    print(f"✅ Prepared {len(service)} images ({service.fmt}, {DEFAULT_WIDTH}px) → {IMAGE_CACHE_DIR}")
@@ -0,0 +1,260 @@
+"""
+Per-turn instrumentation: stage timings, OpenAI token usage and cost, cache
+hits/misses and the path that answered.
+
+Code anywhere in the pipeline calls stage()/record_usage()/record_cache();
+the values are attributed to the turn currently active in this context (if
+any) and always to the process-wide registry. Each finished turn is appended
+to a size-rotated JSONL log (METRICS_DIR/turns.jsonl) and the registry is
+rewritten as a Prometheus text-format file (METRICS_DIR/chat.prom) that a
+node_exporter textfile collector can scrape.
+"""
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Dict, Optional
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_DIR = Path(os.getenv("METRICS_DIR", "metrics"))
+METRICS_LOG_MAX_BYTES = int(os.getenv("METRICS_LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+METRICS_LOG_BACKUPS = int(os.getenv("METRICS_LOG_BACKUPS", "5"))
+
+# USD per 1M tokens (input, output); unknown models are counted without cost
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # seconds
+
+
+def usage_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    price_in, price_out = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+
+# ---------------- Registry ----------------
+class Registry:
+    """Process-wide counters and stage histograms, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.turns = {}        # path -> count
+        self.stages = {}       # stage -> [bucket counts..., sum, count]
+        self.tokens = {}       # (model, kind) -> count
+        self.cost = {}         # model -> USD
+        self.cache = {}        # (cache, result) -> count
+        self.openai = {}       # (kind, event) -> count
+
+    def observe_stage(self, name: str, seconds: float):
+        with self._lock:
+            h = self.stages.setdefault(name, [0] * len(STAGE_BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(STAGE_BUCKETS):
+                if seconds <= bound:
+                    h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def add_usage(self, model: str, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            for kind, n in (("prompt", prompt_tokens), ("completion", completion_tokens)):
+                if n:
+                    self.tokens[(model, kind)] = self.tokens.get((model, kind), 0) + n
+            self.cost[model] = self.cost.get(model, 0.0) + usage_cost(model, prompt_tokens, completion_tokens)
+
+    def add_cache(self, cache: str, hits: int, misses: int):
+        with self._lock:
+            for result, n in (("hit", hits), ("miss", misses)):
+                if n:
+                    self.cache[(cache, result)] = self.cache.get((cache, result), 0) + n
+
+    def add_openai_event(self, kind: str, event: str):
+        with self._lock:
+            self.openai[(kind, event)] = self.openai.get((kind, event), 0) + 1
+
+    def add_turn(self, path: str):
+        with self._lock:
+            self.turns[path] = self.turns.get(path, 0) + 1
+
+    def render(self) -> str:
+        with self._lock:
+            lines = ["# HELP chat_turns_total Chat turns by answering path.", "# TYPE chat_turns_total counter"]
+            lines += [f'chat_turns_total{{path="{p}"}} {n}' for p, n in sorted(self.turns.items())]
+
+            lines += ["# HELP chat_stage_seconds Time spent per pipeline stage.", "# TYPE chat_stage_seconds histogram"]
+            for name, h in sorted(self.stages.items()):
+                for bound, n in zip(STAGE_BUCKETS, h):
+                    lines.append(f'chat_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {n}')
+                lines.append(f'chat_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {h[-1]}')
+                lines.append(f'chat_stage_seconds_sum{{stage="{name}"}} {h[-2]:.6f}')
+                lines.append(f'chat_stage_seconds_count{{stage="{name}"}} {h[-1]}')
+
+            lines += ["# HELP openai_tokens_total OpenAI tokens by model and kind.", "# TYPE openai_tokens_total counter"]
+            lines += [f'openai_tokens_total{{model="{m}",kind="{k}"}} {n}' for (m, k), n in sorted(self.tokens.items())]
+
+            lines += ["# HELP openai_cost_usd_total Estimated OpenAI spend.", "# TYPE openai_cost_usd_total counter"]
+            lines += [f'openai_cost_usd_total{{model="{m}"}} {c:.6f}' for m, c in sorted(self.cost.items())]
+
+            lines += ["# HELP cache_events_total Cache lookups by cache and result.", "# TYPE cache_events_total counter"]
+            lines += [f'cache_events_total{{cache="{c}",result="{r}"}} {n}' for (c, r), n in sorted(self.cache.items())]
+
+            lines += ["# HELP openai_events_total Client-side throttling, retries and failures.",
+                      "# TYPE openai_events_total counter"]
+            lines += [f'openai_events_total{{kind="{k}",event="{e}"}} {n}' for (k, e), n in sorted(self.openai.items())]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+REGISTRY = Registry()
+
+
+# ---------------- Turn ----------------
+class TurnMetrics:
+    def __init__(self, **labels):
+        self.labels = labels
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}          # stage -> ms (summed if a stage runs twice)
+        self.tokens: Dict[str, Dict[str, int]] = {}  # model -> {"prompt", "completion"}
+        self.cost_usd = 0.0
+        self.cache: Dict[str, Dict[str, int]] = {}   # cache -> {"hit", "miss"}
+        self.openai_events: Dict[str, int] = {}      # "<kind>_<event>" -> count
+        self.path: Optional[str] = None
+        self.record: Optional[dict] = None
+        self._lock = threading.Lock()  # stages may run on worker threads
+
+    def add_stage(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds * 1000
+
+    def add_usage(self, model: str, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            t = self.tokens.setdefault(model, {"prompt": 0, "completion": 0})
+            t["prompt"] += prompt_tokens
+            t["completion"] += completion_tokens
+            self.cost_usd += usage_cost(model, prompt_tokens, completion_tokens)
+
+    def add_cache(self, cache: str, hits: int, misses: int):
+        with self._lock:
+            c = self.cache.setdefault(cache, {"hit": 0, "miss": 0})
+            c["hit"] += hits
+            c["miss"] += misses
+
+    def add_openai_event(self, kind: str, event: str):
+        with self._lock:
+            key = f"{kind}_{event}"
+            self.openai_events[key] = self.openai_events.get(key, 0) + 1
+
+    def to_record(self) -> dict:
+        return {
+            "ts": datetime.now().isoformat(timespec="milliseconds"),
+            **self.labels,
+            "path": self.path,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "stages_ms": {k: round(v, 1) for k, v in self.stages.items()},
+            "tokens": self.tokens,
+            "cost_usd": round(self.cost_usd, 6),
+            "cache": self.cache,
+            "openai_events": self.openai_events,
+        }
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("turn_metrics", default=None)
+
+def current_turn() -> Optional[TurnMetrics]:
+    return _current.get()
+
+def start_turn(**labels) -> TurnMetrics:
+    turn = TurnMetrics(**labels)
+    _current.set(turn)
+    return turn
+
+def end_turn(turn: TurnMetrics, path: str) -> dict:
+    """Close the turn: log it, update the registry and rewrite the Prometheus file."""
+    turn.path = path
+    turn.record = turn.to_record()
+    if _current.get() is turn:
+        _current.set(None)
+    if METRICS_ENABLED:
+        REGISTRY.add_turn(path)
+        _turn_log().info(json.dumps(turn.record, ensure_ascii=False))
+        try:
+            REGISTRY.write_prometheus(METRICS_DIR / "chat.prom")
+        except OSError as e:
+            print(f"[Warning] Could not write Prometheus metrics: {e}")
+    return turn.record
+
+
+def observe_stage(name: str, seconds: float):
+    turn = _current.get()
+    if turn is not None:
+        turn.add_stage(name, seconds)
+    REGISTRY.observe_stage(name, seconds)
+
+@contextmanager
+def stage(name: str):
+    """Time a block as a pipeline stage of the current turn (and in the process-wide histogram)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+def record_usage(model: str, usage):
+    """usage: the .usage object of an OpenAI response (may be None)."""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    turn = _current.get()
+    if turn is not None:
+        turn.add_usage(model, prompt_tokens, completion_tokens)
+    REGISTRY.add_usage(model, prompt_tokens, completion_tokens)
+
+def record_cache(cache: str, hits: int = 0, misses: int = 0):
+    turn = _current.get()
+    if turn is not None:
+        turn.add_cache(cache, hits, misses)
+    REGISTRY.add_cache(cache, hits, misses)
+
+def record_openai_event(kind: str, event: str):
+    """event: throttled | retry | failed (see utils/openai_client.py)"""
+    turn = _current.get()
+    if turn is not None:
+        turn.add_openai_event(kind, event)
+    REGISTRY.add_openai_event(kind, event)
+
+
+# ---------------- JSONL Log ----------------
+_log = None
+_log_lock = threading.Lock()
+
+def _turn_log() -> logging.Logger:
+    global _log
+    with _log_lock:
+        if _log is None:
+            METRICS_DIR.mkdir(parents=True, exist_ok=True)
+            handler = RotatingFileHandler(
+                METRICS_DIR / "turns.jsonl", maxBytes=METRICS_LOG_MAX_BYTES,
+                backupCount=METRICS_LOG_BACKUPS, encoding="utf-8",
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger("cereaura.metrics")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            _log = logger
+        return _log
@@ -0,0 +1,189 @@
+"""
+One shared OpenAI client for the app, the memory manager and ingestion.
+
+- one pooled keep-alive HTTP connection pool for every request
+- client-side token buckets on requests and tokens per minute, separately for
+  embeddings and chat, so bursts queue locally instead of hitting 429s
+- retries with jittered exponential backoff (honouring Retry-After) on rate
+  limits, timeouts, connection errors and 5xx responses
+- saturation counters (throttle waits, retries, failures, in flight) in
+  stats() and in the metrics registry
+
+get_openai_client() returns a drop-in object: call sites keep using
+client.embeddings.create(...) and client.chat.completions.create(...).
+"""
+import os
+import time
+import random
+import threading
+from typing import Dict
+
+import httpx
+from openai import OpenAI, DefaultHttpxClient, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+from utils.context_builder import count_tokens, message_tokens
+from utils.metrics import observe_stage, record_openai_event
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "6"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))  # seconds, doubled per attempt
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "30"))
+# per-minute limits; set them a little under the account's tier limits
+LIMITS = {
+    "embeddings": (int(os.getenv("OPENAI_EMBED_RPM", "3000")), int(os.getenv("OPENAI_EMBED_TPM", "1000000"))),
+    "chat": (int(os.getenv("OPENAI_CHAT_RPM", "500")), int(os.getenv("OPENAI_CHAT_TPM", "200000"))),
+}
+RETRYABLE = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+class TokenBucket:
+    """Refills continuously at rate_per_minute, holding at most one minute's worth."""
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, n: float = 1.0) -> float:
+        """Block until n tokens are available and take them; returns the seconds waited."""
+        n = min(n, self.capacity)  # an oversized request waits for a full bucket rather than forever
+        waited = 0.0
+        with self._cond:
+            self._refill()
+            while self.tokens < n:
+                delay = (n - self.tokens) / self.rate
+                started = time.monotonic()
+                self._cond.wait(delay)
+                waited += time.monotonic() - started
+                self._refill()
+            self.tokens -= n
+        return waited
+
+
+class _Limiter:
+    def __init__(self, kind: str, rpm: int, tpm: int):
+        self.kind = kind
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "throttled": 0, "throttle_seconds": 0.0,
+                      "retries": 0, "failures": 0, "in_flight": 0}
+
+    def _bump(self, key: str, by=1):
+        with self._lock:
+            self.stats[key] += by
+
+    def call(self, fn, est_tokens: int, **kwargs):
+        waited = self.requests.acquire(1) + self.tokens.acquire(est_tokens)
+        if waited > 0:
+            self._bump("throttled")
+            self._bump("throttle_seconds", waited)
+            record_openai_event(self.kind, "throttled")
+            observe_stage(f"ratelimit_wait_{self.kind}", waited)
+
+        self._bump("requests")
+        self._bump("in_flight")
+        try:
+            for attempt in range(OPENAI_MAX_RETRIES + 1):
+                try:
+                    return fn(**kwargs)
+                except RETRYABLE as e:
+                    if attempt == OPENAI_MAX_RETRIES:
+                        self._bump("failures")
+                        record_openai_event(self.kind, "failed")
+                        raise
+                    delay = _backoff(attempt, e)
+                    self._bump("retries")
+                    record_openai_event(self.kind, "retry")
+                    print(f"[Warning] OpenAI {self.kind} {e.__class__.__name__}, retry {attempt + 1} in {delay:.1f}s")
+                    time.sleep(delay)
+                    self.requests.acquire(1)
+        finally:
+            self._bump("in_flight", -1)
+
+
+def _backoff(attempt: int, error: Exception) -> float:
+    """Full-jitter exponential backoff; a server-sent Retry-After wins when it is longer."""
+    delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        delay = max(delay, float(retry_after)) if retry_after else delay
+    except ValueError:
+        pass
+    return min(delay, OPENAI_BACKOFF_MAX)
+
+
+class _Embeddings:
+    def __init__(self, client: OpenAI, limiter: _Limiter):
+        self._client = client
+        self._limiter = limiter
+
+    def create(self, **kwargs):
+        texts = kwargs.get("input")
+        texts = [texts] if isinstance(texts, str) else texts
+        est = sum(count_tokens(t) for t in texts)
+        return self._limiter.call(self._client.embeddings.create, est, **kwargs)
+
+
+class _Completions:
+    def __init__(self, client: OpenAI, limiter: _Limiter):
+        self._client = client
+        self._limiter = limiter
+
+    def create(self, **kwargs):
+        est = sum(message_tokens(m) for m in kwargs.get("messages", [])) + kwargs.get("max_tokens", 0)
+        return self._limiter.call(self._client.chat.completions.create, est, **kwargs)
+
+
+class _Chat:
+    def __init__(self, completions: _Completions):
+        self.completions = completions
+
+
+class SharedOpenAI:
+    """Rate-limited, retrying facade over one pooled OpenAI client."""
+
+    def __init__(self, api_key: str = None):
+        self.http_client = DefaultHttpxClient(
+            limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                                max_keepalive_connections=OPENAI_MAX_CONNECTIONS),
+            timeout=OPENAI_TIMEOUT,
+        )
+        # retries are handled here, per limiter, so the SDK's own retry loop is off
+        self.raw = OpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"), http_client=self.http_client, max_retries=0)
+        self.limiters = {kind: _Limiter(kind, rpm, tpm) for kind, (rpm, tpm) in LIMITS.items()}
+        self.embeddings = _Embeddings(self.raw, self.limiters["embeddings"])
+        self.chat = _Chat(_Completions(self.raw, self.limiters["chat"]))
+
+    def stats(self) -> Dict[str, dict]:
+        """Saturation counters per kind, plus the tokens currently left in each bucket."""
+        out = {}
+        for kind, limiter in self.limiters.items():
+            with limiter._lock:
+                out[kind] = dict(limiter.stats)
+            out[kind]["request_budget"] = round(limiter.requests.tokens, 1)
+            out[kind]["token_budget"] = round(limiter.tokens.tokens)
+        return out
+
+    def close(self):
+        self.http_client.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_openai_client() -> SharedOpenAI:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = SharedOpenAI()
+        return _client
@@ -0,0 +1,137 @@
+import json
+import threading
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from utils.files import FileLock
+from utils.ranking import top_k
+
+
+class PackedIndex:
+    """
+    Per-user embedding index of packed summaries from all of the user's sessions.
+    Rows are unit-normalized float32 vectors appended to user_<id>_packed.f32, with
+    one metadata line per row in user_<id>_packed.jsonl, so adding a summary is an
+    append rather than a rewrite.
+
+    Every MemoryManager of the user (one per tab, across Streamlit processes) has
+    its own instance over the same files, so reads and appends hold an exclusive
+    lock on user_<id>_packed.lock and first pick up rows other instances added.
+    The two appends are still separate writes: a crash between them is repaired
+    on the next read by cutting both files back to the rows they have in common.
+    Rows live in a buffer that doubles when full, and search is one matrix-vector
+    product over the filled part.
+    """
+
+    def __init__(self, user_id: str, base_folder: Path):
+        base_folder = Path(base_folder)
+        self.vec_path = base_folder / f"user_{user_id}_packed.f32"
+        self.meta_path = base_folder / f"user_{user_id}_packed.jsonl"
+        self._file_lock = FileLock(base_folder / f"user_{user_id}_packed.lock")
+        self._lock = threading.Lock()
+        self.entries = []
+        self.matrix = None        # view of the first len(entries) rows of _buf
+        self._buf = None
+        self._keys = set()
+        self._meta_bytes = 0      # metadata bytes already read
+
+    def exists(self) -> bool:
+        return self.meta_path.exists()
+
+    def has(self, session_id: str, timestamp: str) -> bool:
+        return (session_id, timestamp) in self._keys
+
+    def load(self):
+        with self._lock, self._file_lock:
+            self.entries, self.matrix, self._buf, self._keys, self._meta_bytes = [], None, None, set(), 0
+            self._read_new()
+
+    def _read_new(self):
+        """Read rows appended since the last read and repair a torn tail. Called with both locks held."""
+        if not self.exists():
+            return
+        metas, ends = [], []
+        with open(self.meta_path, "rb") as f:
+            f.seek(self._meta_bytes)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    metas.append(json.loads(line))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break
+                ends.append((ends[-1] if ends else self._meta_bytes) + len(line))
+
+        n = len(self.entries)
+        dim = self.entries[0]["dim"] if self.entries else (metas[0]["dim"] if metas else 0)
+        rows = 0
+        if metas and self.vec_path.exists():
+            available = self.vec_path.stat().st_size // 4 // dim - n
+            rows = max(0, min(len(metas), available))
+            if rows:
+                vecs = np.fromfile(self.vec_path, dtype=np.float32, count=rows * dim, offset=n * dim * 4)
+                self._append_rows(vecs.reshape(rows, dim))
+                self.entries.extend(metas[:rows])
+                self._keys.update((m["session_id"], m["timestamp"]) for m in metas[:rows])
+        if rows:
+            self._meta_bytes = ends[rows - 1]
+        # nobody else is writing while we hold the lock, so anything past the common rows is a torn add
+        self._truncate(self._meta_bytes, len(self.entries) * dim * 4)
+
+    def _truncate(self, meta_bytes: int, vec_bytes: int):
+        """Cut both files back to the rows they have in common so the next append starts aligned."""
+        for path, size in ((self.meta_path, meta_bytes), (self.vec_path, vec_bytes)):
+            if path.exists() and path.stat().st_size > size:
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+
+    def _append_rows(self, vecs: np.ndarray):
+        n = len(self.entries)
+        if self._buf is None or n + len(vecs) > len(self._buf):
+            grown = np.empty((max(16, 2 * (n + len(vecs))), vecs.shape[1]), dtype=np.float32)
+            if n:
+                grown[:n] = self.matrix
+            self._buf = grown
+        self._buf[n:n + len(vecs)] = vecs
+        self.matrix = self._buf[:n + len(vecs)]
+
+    def add_many(self, items: List[Tuple[str, dict, np.ndarray]]):
+        """Append (session_id, packed block, embedding) rows; blocks already indexed are skipped."""
+        if not items:
+            return
+        with self._lock, self._file_lock:
+            self._read_new()
+            items = [it for it in items if (it[0], it[1]["timestamp"]) not in self._keys]
+            if not items:
+                return
+            vecs = np.vstack([np.asarray(v, dtype=np.float32) for _, _, v in items])
+            vecs /= np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+            metas = [
+                {"session_id": sid, "summary": block["summary"], "timestamp": block["timestamp"], "dim": vecs.shape[1]}
+                for sid, block, _ in items
+            ]
+            data = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in metas).encode("utf-8")
+            with open(self.vec_path, "ab") as f:
+                f.write(vecs.tobytes())
+            with open(self.meta_path, "ab") as f:
+                f.write(data)
+            self._append_rows(vecs)
+            self.entries.extend(metas)
+            self._keys.update((m["session_id"], m["timestamp"]) for m in metas)
+            self._meta_bytes += len(data)
+
+    def add(self, session_id: str, block: dict, embedding: np.ndarray):
+        self.add_many([(session_id, block, embedding)])
+
+    def search(self, query_embedding, k: int = 3) -> List[Tuple[dict, float]]:
+        """Top-k (entry, cosine similarity) pairs, best first."""
+        with self._lock:
+            if self.matrix is None or not len(self.entries):
+                return []
+            q = np.asarray(query_embedding, dtype=np.float32)
+            q = q / (np.linalg.norm(q) or 1.0)
+            scores = self.matrix @ q
+            top = top_k(scores, k)
+            return [(self.entries[i], float(scores[i])) for i in top]
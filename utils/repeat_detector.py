@@ -0,0 +1,72 @@
+import re
+import hashlib
+import unicodedata
+from collections import defaultdict
+from typing import Dict, Optional, Set, Tuple
+
+_PUNCT = re.compile(r"[^\w\s]")
+
+
+def normalize_question(text: str) -> str:
+    """NFKC, case-folded, whitespace-collapsed text without punctuation."""
+    return " ".join(_PUNCT.sub(" ", unicodedata.normalize("NFKC", text).casefold()).split())
+
+def trigrams(norm: str) -> Set[str]:
+    padded = f"  {norm} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class RepeatDetector:
+    """
+    Finds a previously answered question that matches a new query.
+    Exact repeats (after normalization) are a single hash-map lookup; near repeats
+    are scored by Dice similarity of character-trigram sets, using an inverted
+    index so only entries sharing at least one trigram are touched.
+    Each entry maps directly to the answer that followed the question.
+    """
+
+    def __init__(self):
+        self._exact: Dict[bytes, int] = {}
+        self._grams: Dict[int, Set[str]] = {}
+        self._index: Dict[str, Set[int]] = defaultdict(set)
+        self._answers: Dict[int, str] = {}
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._answers)
+
+    @staticmethod
+    def _digest(norm: str) -> bytes:
+        return hashlib.blake2b(norm.encode("utf-8"), digest_size=16).digest()
+
+    def add(self, question: str, answer: str):
+        norm = normalize_question(question)
+        entry = self._next_id
+        self._next_id += 1
+        self._exact[self._digest(norm)] = entry  # newest answer wins for identical questions
+        grams = trigrams(norm)
+        self._grams[entry] = grams
+        for g in grams:
+            self._index[g].add(entry)
+        self._answers[entry] = answer
+
+    def lookup(self, query: str) -> Tuple[Optional[str], float]:
+        """Return (answer, similarity) for the closest stored question, or (None, 0.0)."""
+        norm = normalize_question(query)
+        entry = self._exact.get(self._digest(norm))
+        if entry is not None:
+            return self._answers[entry], 1.0
+
+        grams = trigrams(norm)
+        overlap: Dict[int, int] = defaultdict(int)
+        for g in grams:
+            for e in self._index.get(g, ()):
+                overlap[e] += 1
+        best, best_score = None, 0.0
+        for e, shared in overlap.items():
+            score = 2.0 * shared / (len(grams) + len(self._grams[e]))
+            if score > best_score or (score == best_score and best is not None and e > best):
+                best, best_score = e, score
+        if best is None:
+            return None, 0.0
+        return self._answers[best], best_score
@@ -0,0 +1,169 @@
+"""
+KB retrieval: hybrid vector + BM25 candidate search fused with reciprocal rank
+fusion, then context selection — maximal-marginal-relevance ordering over the
+embeddings Chroma returns, merging of overlapping neighbouring chunks from the
+same source/page, and packing to a token budget instead of a character cap.
+"""
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from utils.context_builder import count_tokens
+
+KB_TOKEN_BUDGET = int(os.getenv("KB_TOKEN_BUDGET", "3000"))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))  # 1.0 = pure relevance, 0.0 = pure diversity
+DUPLICATE_SIM = 0.95      # candidates this similar to an already chosen chunk are dropped outright
+MIN_OVERLAP = 20          # chars; shorter suffix/prefix matches are treated as coincidence
+MAX_OVERLAP = 400         # chars; splitter overlap is 150, leave headroom for whitespace differences
+RRF_K = 60                # reciprocal rank fusion damping constant
+LEXICAL_KEEP = 4          # BM25 hits ranked this high are kept even without a close vector distance
+
+
+# ---------------- Hybrid Search ----------------
+def hybrid_search(collection, lexical_index, query_text: str, query_embedding,
+                  n_results: int = 12, max_distance: float = 0.4, should_stop=None) -> List[Dict]:
+    """
+    Vector search plus in-process BM25 over the same chunk IDs, fused by reciprocal rank.
+    A candidate is kept if its vector distance is below max_distance or it is one of
+    the top LEXICAL_KEEP lexical hits; if nothing qualifies the two best fused hits are used.
+    Returns [{"id", "text", "metadata", "embedding", "distance"}] in fused order, or []
+    as soon as should_stop() turns true between steps.
+    """
+    if should_stop is not None and should_stop():
+        return []
+    q = collection.query(
+        query_embeddings=[np.asarray(query_embedding).tolist()],
+        n_results=n_results,
+        include=["documents", "metadatas", "distances", "embeddings"],
+    )
+    ids = q.get("ids", [[]])[0]
+    docs = q.get("documents", [[]])[0]
+    metas = q.get("metadatas", [[]])[0]
+    dists = (q.get("distances") or [[0.0] * len(ids)])[0]
+    embs = q.get("embeddings")
+    embs = list(embs[0]) if embs is not None and len(embs) else [None] * len(ids)
+
+    cands = {
+        cid: {"id": cid, "text": d, "metadata": m or {}, "embedding": e, "distance": dist}
+        for cid, d, m, e, dist in zip(ids, docs, metas, embs, dists)
+    }
+    fused = {cid: 1.0 / (RRF_K + rank) for rank, cid in enumerate(ids, 1)}
+
+    lexical = lexical_index.search(query_text, n_results) if lexical_index is not None else []
+    lexical_top = set()
+    for rank, (cid, _) in enumerate(lexical, 1):
+        fused[cid] = fused.get(cid, 0.0) + 1.0 / (RRF_K + rank)
+        if rank <= LEXICAL_KEEP:
+            lexical_top.add(cid)
+
+    if should_stop is not None and should_stop():
+        return []
+    missing = [cid for cid, _ in lexical if cid not in cands]
+    if missing:
+        got = collection.get(ids=missing, include=["documents", "metadatas", "embeddings"])
+        g_embs = got.get("embeddings")
+        g_embs = list(g_embs) if g_embs is not None and len(g_embs) else [None] * len(got["ids"])
+        for cid, d, m, e in zip(got["ids"], got["documents"], got["metadatas"], g_embs):
+            cands[cid] = {"id": cid, "text": d, "metadata": m or {}, "embedding": e, "distance": None}
+
+    ranked = [cands[cid] for cid in sorted(fused, key=fused.get, reverse=True) if cid in cands]
+    kept = [c for c in ranked
+            if (c["distance"] is not None and c["distance"] < max_distance) or c["id"] in lexical_top]
+    return kept or ranked[:2]
+
+
+# ---------------- Context Packing ----------------
+def _unit(m: np.ndarray) -> np.ndarray:
+    return m / np.maximum(np.linalg.norm(m, axis=-1, keepdims=True), 1e-12)
+
+def mmr_order(query_embedding, embeddings, lambda_: float = MMR_LAMBDA) -> List[int]:
+    """Indices of embeddings in MMR order, with near-duplicates of earlier picks removed."""
+    if len(embeddings) == 0:
+        return []
+    docs = _unit(np.asarray(embeddings, dtype=np.float32))
+    relevance = docs @ _unit(np.asarray(query_embedding, dtype=np.float32))
+    pairwise = docs @ docs.T
+
+    order, remaining = [], list(range(len(docs)))
+    max_sim = np.full(len(docs), -1.0, dtype=np.float32)
+    while remaining:
+        scores = [lambda_ * relevance[i] - (1 - lambda_) * max(max_sim[i], 0.0) for i in remaining]
+        best = remaining.pop(int(np.argmax(scores)))
+        order.append(best)
+        max_sim = np.maximum(max_sim, pairwise[best])
+        remaining = [i for i in remaining if max_sim[i] < DUPLICATE_SIM]
+    return order
+
+
+def _overlap(a: str, b: str) -> int:
+    """Length of the longest suffix of a that is a prefix of b (0 if below MIN_OVERLAP)."""
+    if len(a) < MIN_OVERLAP or len(b) < MIN_OVERLAP:
+        return 0
+    probe = b[:MIN_OVERLAP]
+    start = max(0, len(a) - MAX_OVERLAP)
+    idx = a.find(probe, start)
+    while idx != -1:
+        if b.startswith(a[idx:]):
+            return len(a) - idx
+        idx = a.find(probe, idx + 1)
+    return 0
+
+def _source_key(meta: Dict):
+    return meta.get("file", meta.get("source", "kb")), meta.get("page")
+
+def merge_adjacent(chunks: List[Dict]) -> List[Dict]:
+    """
+    Join chunks from the same source and page whose text overlaps end-to-start
+    (the splitter's chunk_overlap), keeping the position of the earliest one.
+    Each chunk is {"text", "metadata"}.
+    """
+    merged = [dict(c) for c in chunks]
+    changed = True
+    while changed:
+        changed = False
+        for i, a in enumerate(merged):
+            for j, b in enumerate(merged):
+                if i == j or _source_key(a["metadata"]) != _source_key(b["metadata"]):
+                    continue
+                n = _overlap(a["text"], b["text"])
+                if n:
+                    keep, drop = (i, j) if i < j else (j, i)
+                    merged[keep] = {**merged[keep], "text": a["text"] + b["text"][n:]}
+                    del merged[drop]
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+def format_segment(chunk: Dict) -> str:
+    src = chunk["metadata"].get("file", chunk["metadata"].get("source", "kb"))
+    return f"\n---\nSource: {src}\n---\n{chunk['text']}"
+
+def pack_context(query_embedding, documents, metadatas, embeddings,
+                 budget: int = KB_TOKEN_BUDGET) -> Tuple[str, List[Dict]]:
+    """
+    Choose KB evidence for the prompt: MMR-order the candidates, merge overlapping
+    neighbours, then add segments until the token budget is spent.
+    Returns (context text, chunks used).
+    """
+    if not documents:
+        return "", []
+    if embeddings is not None and len(embeddings) == len(documents):
+        order = mmr_order(query_embedding, embeddings)
+    else:
+        order = list(range(len(documents)))
+    chunks = merge_adjacent([{"text": documents[i], "metadata": metadatas[i] or {}} for i in order])
+
+    out, used, spent = [], [], 0
+    for chunk in chunks:
+        seg = format_segment(chunk)
+        cost = count_tokens(seg)
+        if spent + cost > budget:
+            continue  # a shorter later chunk may still fit
+        out.append(seg)
+        used.append(chunk)
+        spent += cost
+    return "\n".join(out), used
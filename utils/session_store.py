@@ -0,0 +1,400 @@
+"""
+Storage backends for MemoryManager.
+
+Every backend exposes the same write operations, called after MemoryManager has
+applied the change to its in-memory session dict:
+    create_session(session_id, session)
+    append_message(session_id, msg)
+    commit_pack(session_id, block, n_packed)   # n_packed oldest "recent" messages → block
+and the same reads:
+    load()                    # sessions to keep in memory up front ({} for lazy backends)
+    load_session(session_id)  # one session dict, or None
+    session_ids()             # every session of the user, oldest first
+    packed_keys()             # (session_id, timestamp) of every packed block of the user
+"""
+import os
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+from utils.files import FileLock
+
+
+class JsonSessionStore:
+    """Original format: the whole sessions/user_<id>.json is rewritten on every change."""
+
+    def __init__(self, user_id: str, base_folder: Path):
+        self.save_path = Path(base_folder) / f"user_{user_id}.json"
+        self.sessions = {}
+
+    def load(self) -> dict:
+        if self.save_path.exists():
+            with open(self.save_path, "r", encoding="utf-8") as f:
+                self.sessions = json.load(f)
+        else:
+            self.sessions = {}
+        return self.sessions
+
+    def load_session(self, session_id: str):
+        return self.sessions.get(session_id)
+
+    def session_ids(self):
+        return list(self.sessions)
+
+    def packed_keys(self):
+        return [(sid, b["timestamp"]) for sid, session in self.sessions.items() for b in session["packed"]]
+
+    def save(self):
+        with open(self.save_path, "w", encoding="utf-8") as f:
+            json.dump(self.sessions, f, indent=2, ensure_ascii=False)
+
+    def create_session(self, session_id: str, session: dict):
+        self.save()
+
+    def append_message(self, session_id: str, msg: dict):
+        self.save()
+
+    def commit_pack(self, session_id: str, block: dict, n_packed: int):
+        self.save()
+
+    def close(self):
+        pass
+
+
+class JournalSessionStore:
+    """
+    Append-only storage: one compact JSON line per session/message/pack event in
+    user_<id>.journal, periodically compacted into user_<id>.snapshot.json.
+    Each record carries a sequence number and the snapshot stores the last one it
+    covers, so a crash between writing the snapshot and truncating the journal
+    never replays an event twice. On first use the legacy user_<id>.json seeds
+    the snapshot.
+
+    Several processes may write for the same user: every write and compaction
+    holds an exclusive lock on user_<id>.journal.lock and first replays whatever
+    the others appended (or reloads after a compaction they ran), so sequence
+    numbers are allocated from the shared journal, never from a stale counter.
+    """
+
+    def __init__(self, user_id: str, base_folder: Path, compact_every: int = 500):
+        base_folder = Path(base_folder)
+        self.legacy_path = base_folder / f"user_{user_id}.json"
+        self.snapshot_path = base_folder / f"user_{user_id}.snapshot.json"
+        self.journal_path = base_folder / f"user_{user_id}.journal"
+        self.compact_every = compact_every
+        self.sessions = {}
+        self.seq = 0
+        self._journal_len = 0
+        self._offset = 0              # journal bytes already applied
+        self._snapshot_seen = None    # snapshot (mtime, size) the state was loaded from
+        self._fh = None
+        self._lock = FileLock(base_folder / f"user_{user_id}.journal.lock")
+
+    # ----------------------------
+    # Load: snapshot + journal replay
+    # ----------------------------
+    def load(self) -> dict:
+        self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self.sessions = {}
+            self._reload()
+        return self.sessions
+
+    def _snapshot_stamp(self):
+        try:
+            st = self.snapshot_path.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _reload(self):
+        fresh, seq = {}, 0
+        if self.snapshot_path.exists():
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snap = json.load(f)
+            fresh, seq = snap["sessions"], snap["seq"]
+        elif self.legacy_path.exists():
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                fresh = json.load(f)
+        # update in place: MemoryManager holds this dict and the session dicts in it
+        for sid, session in fresh.items():
+            if sid in self.sessions:
+                self.sessions[sid].clear()
+                self.sessions[sid].update(session)
+            else:
+                self.sessions[sid] = session
+        self.seq = seq
+        self._snapshot_seen = self._snapshot_stamp()
+        self._offset, self._journal_len = 0, 0
+        self._replay()
+
+    def _replay(self):
+        """Apply journal records past self._offset. Called with the lock held."""
+        if not self.journal_path.exists():
+            return
+        with open(self.journal_path, "rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    rec = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break
+                self._offset += len(line)
+                self._journal_len += 1
+                if rec["seq"] > self.seq:
+                    self._apply(rec)
+                    self.seq = rec["seq"]
+        if self._offset < self.journal_path.stat().st_size:
+            # Torn final write from a crash (writers hold the lock, so nobody is mid-write): drop it
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(self._offset)
+
+    def _sync(self) -> bool:
+        """Catch up with other writers; True if state was reloaded. Called with the lock held."""
+        if self._snapshot_stamp() != self._snapshot_seen:
+            self._reload()  # someone compacted: the journal we were reading is gone
+            return True
+        self._replay()
+        return False
+
+    def load_session(self, session_id: str):
+        return self.sessions.get(session_id)
+
+    def session_ids(self):
+        return list(self.sessions)
+
+    def packed_keys(self):
+        return [(sid, b["timestamp"]) for sid, session in self.sessions.items() for b in session["packed"]]
+
+    def _apply(self, rec: dict):
+        op, sid = rec["op"], rec["sid"]
+        if op == "session":
+            self.sessions[sid] = rec["session"]
+        elif op == "msg":
+            self.sessions[sid]["recent"].append(rec["msg"])
+        elif op == "pack":
+            session = self.sessions[sid]
+            session["recent"] = session["recent"][rec["n"]:]
+            session["packed"].append(rec["block"])
+
+    # ----------------------------
+    # Writes: one appended line each
+    # ----------------------------
+    def _append(self, rec: dict):
+        with self._lock:
+            reloaded = self._sync()
+            self.seq += 1
+            rec["seq"] = self.seq
+            if reloaded:
+                self._apply(rec)  # the reload replaced the change MemoryManager had already made
+            line = (json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+            if self._fh is None:
+                self._fh = open(self.journal_path, "ab")
+            self._fh.write(line)
+            self._fh.flush()
+            self._offset += len(line)
+            self._journal_len += 1
+            if self._journal_len >= self.compact_every:
+                self._compact()
+
+    def create_session(self, session_id: str, session: dict):
+        self._append({"op": "session", "sid": session_id, "session": session})
+
+    def append_message(self, session_id: str, msg: dict):
+        self._append({"op": "msg", "sid": session_id, "msg": msg})
+
+    def commit_pack(self, session_id: str, block: dict, n_packed: int):
+        self._append({"op": "pack", "sid": session_id, "n": n_packed, "block": block})
+
+    # ----------------------------
+    # Compaction
+    # ----------------------------
+    def compact(self):
+        with self._lock:
+            self._sync()
+            self._compact()
+
+    def _compact(self):
+        tmp = self.snapshot_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"seq": self.seq, "sessions": self.sessions}, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, self.snapshot_path)
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        open(self.journal_path, "w").close()
+        self._snapshot_seen = self._snapshot_stamp()
+        self._offset, self._journal_len = 0, 0
+
+    def save(self):
+        self.compact()
+
+    def close(self):
+        if self._journal_len:
+            self.compact()
+        elif self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        self._lock.close()
+
+
+class SqliteSessionStore:
+    """
+    All users' sessions in one local SQLite database (sessions/sessions.sqlite3)
+    with indexed session, message and packed-summary tables. Nothing is loaded
+    up front: load_session() reads one session's unpacked messages and its
+    summaries when MemoryManager first touches it. Packed messages stay in the
+    messages table (flagged) rather than being deleted.
+    A user's legacy user_<id>.json is imported the first time they are opened.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        user_name TEXT,
+        created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id, created_at);
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL REFERENCES sessions(id),
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        packed INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, packed, id);
+    CREATE TABLE IF NOT EXISTS packed (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL REFERENCES sessions(id),
+        summary TEXT NOT NULL,
+        timestamp TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_packed_session ON packed(session_id, id);
+    """
+
+    def __init__(self, user_id: str, base_folder: Path, db_name: str = "sessions.sqlite3"):
+        self.user_id = str(user_id)
+        self.legacy_path = Path(base_folder) / f"user_{user_id}.json"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(Path(base_folder) / db_name), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._import_legacy()
+
+    def _import_legacy(self):
+        if not self.legacy_path.exists():
+            return
+        with self._lock, self._conn:
+            if self._conn.execute("SELECT 1 FROM sessions WHERE user_id = ? LIMIT 1", (self.user_id,)).fetchone():
+                return
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+            for sid, session in legacy.items():
+                self._insert_session(sid, session)
+                self._conn.executemany(
+                    "INSERT INTO packed (session_id, summary, timestamp) VALUES (?, ?, ?)",
+                    [(sid, b["summary"], b["timestamp"]) for b in session.get("packed", [])],
+                )
+                self._conn.executemany(
+                    "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
+                    [(sid, m["role"], m["content"]) for m in session.get("recent", [])],
+                )
+
+    def _insert_session(self, session_id: str, session: dict):
+        self._conn.execute(
+            "INSERT OR IGNORE INTO sessions (id, user_id, user_name, created_at) VALUES (?, ?, ?, ?)",
+            (session_id, str(session.get("user_id", self.user_id)), session.get("user_name"), session["created_at"]),
+        )
+
+    # ----------------------------
+    # Reads
+    # ----------------------------
+    def load(self) -> dict:
+        return {}
+
+    def load_session(self, session_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT user_id, user_name, created_at FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            recent = self._conn.execute(
+                "SELECT role, content FROM messages WHERE session_id = ? AND packed = 0 ORDER BY id", (session_id,)
+            ).fetchall()
+            packed = self._conn.execute(
+                "SELECT summary, timestamp FROM packed WHERE session_id = ? ORDER BY id", (session_id,)
+            ).fetchall()
+        return {
+            "user_id": row[0],
+            "user_name": row[1],
+            "created_at": row[2],
+            "recent": [{"role": r, "content": c} for r, c in recent],
+            "packed": [{"summary": s, "timestamp": t} for s, t in packed],
+        }
+
+    def session_ids(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM sessions WHERE user_id = ? ORDER BY created_at", (self.user_id,)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def packed_keys(self):
+        """One indexed query over packed; unlike load_session() it reads no messages."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT p.session_id, p.timestamp FROM packed p JOIN sessions s ON s.id = p.session_id"
+                " WHERE s.user_id = ? ORDER BY p.id", (self.user_id,)
+            ).fetchall()
+        return [(sid, ts) for sid, ts in rows]
+
+    # ----------------------------
+    # Writes
+    # ----------------------------
+    def create_session(self, session_id: str, session: dict):
+        with self._lock, self._conn:
+            self._insert_session(session_id, session)
+
+    def append_message(self, session_id: str, msg: dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
+                (session_id, msg["role"], msg["content"]),
+            )
+
+    def commit_pack(self, session_id: str, block: dict, n_packed: int):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE messages SET packed = 1 WHERE id IN "
+                "(SELECT id FROM messages WHERE session_id = ? AND packed = 0 ORDER BY id LIMIT ?)",
+                (session_id, n_packed),
+            )
+            self._conn.execute(
+                "INSERT INTO packed (session_id, summary, timestamp) VALUES (?, ?, ?)",
+                (session_id, block["summary"], block["timestamp"]),
+            )
+
+    def save(self):
+        pass  # every write is already committed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+STORES = {
+    "json": JsonSessionStore,
+    "journal": JournalSessionStore,
+    "sqlite": SqliteSessionStore,
+}
+
+def make_store(kind: str, user_id: str, base_folder: Path):
+    if kind not in STORES:
+        raise ValueError(f"Unknown session storage '{kind}' (expected one of {', '.join(STORES)})")
+    return STORES[kind](user_id, base_folder)
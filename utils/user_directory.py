@@ -0,0 +1,106 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+USER_DB_PATH = Path(os.getenv("USER_DB_PATH", "db/users.sqlite3"))
+START_ID = 1000
+MAX_ID = 9999
+
+
+class UserExistsError(Exception):
+    pass
+
+class UserIdExhaustedError(Exception):
+    pass
+
+
+def name_key(name: str) -> str:
+    return name.strip().casefold()
+
+
+class UserDirectory:
+    """
+    User profiles in a local SQLite table with a unique index on the case-folded
+    name, so login is one indexed lookup. IDs are allocated inside a
+    BEGIN IMMEDIATE transaction, which serializes concurrent registrations
+    (across threads and processes) and makes duplicate IDs impossible.
+    """
+
+    def __init__(self, path: Path = USER_DB_PATH, start_id: int = START_ID, max_id: int = MAX_ID):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.start_id = start_id
+        self.max_id = max_id
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " id INTEGER PRIMARY KEY,"
+            " name TEXT NOT NULL,"
+            " name_key TEXT NOT NULL,"
+            " age INTEGER,"
+            " has_autistic_child INTEGER NOT NULL DEFAULT 0,"
+            " created_at TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_name_key ON users(name_key)")
+
+    @staticmethod
+    def _row_to_user(row) -> dict:
+        return {"id": f"{row[0]:04d}", "name": row[1], "age": row[2], "has_autistic_child": row[3]}
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def get_by_name(self, name: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, name, age, has_autistic_child FROM users WHERE name_key = ?", (name_key(name),)
+            ).fetchone()
+        return self._row_to_user(row) if row else None
+
+    def register(self, name: str, age: int, has_autistic_child: int) -> dict:
+        """Allocate the next ID and insert the profile atomically."""
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                next_id = self._conn.execute(
+                    "SELECT COALESCE(MAX(id), ?) + 1 FROM users", (self.start_id - 1,)
+                ).fetchone()[0]
+                if next_id > self.max_id:
+                    raise UserIdExhaustedError("User ID limit reached.")
+                self._conn.execute(
+                    "INSERT INTO users (id, name, name_key, age, has_autistic_child, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (next_id, name.strip(), name_key(name), int(age), int(has_autistic_child), datetime.now().isoformat()),
+                )
+                self._conn.execute("COMMIT")
+            except sqlite3.IntegrityError:
+                self._conn.execute("ROLLBACK")
+                raise UserExistsError(f"User '{name.strip()}' already exists.")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return {"id": f"{next_id:04d}", "name": name.strip(), "age": int(age), "has_autistic_child": int(has_autistic_child)}
+
+    def import_profiles(self, metadatas) -> int:
+        """One-time import of existing profile metadata (e.g. from the Chroma "users" collection)."""
+        rows = []
+        for meta in metadatas or []:
+            try:
+                rows.append((int(meta["id"]), meta["name"].strip(), name_key(meta["name"]),
+                             meta.get("age"), int(meta.get("has_autistic_child", 0)), datetime.now().isoformat()))
+            except (KeyError, ValueError, TypeError, AttributeError):
+                continue
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            cur = self._conn.executemany(
+                "INSERT OR IGNORE INTO users (id, name, name_key, age, has_autistic_child, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            self._conn.execute("COMMIT")
+        return cur.rowcount
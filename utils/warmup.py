@@ -0,0 +1,117 @@
+"""
+Deferred start-up for the Streamlit process.
+
+chat.py imports only Streamlit and the login page up front. Heavy modules
+(chromadb, openai, numpy, demo_answers, the engine) and slow one-time setup
+(Chroma open, demo index, image derivatives, local summarizer) are registered
+here as named tasks and run on one background thread once the login page has
+rendered. Code that needs a result calls WARMUP.result(name): it waits if the
+task is running, or runs it inline if warm-up never got to it.
+
+The timings of every task and import, plus the time from process start to the
+first login render, are printed once warm-up finishes and are available from
+WARMUP.report(). For a per-module breakdown use `python -X importtime`.
+"""
+import time
+import importlib
+import threading
+from typing import Callable, Dict
+
+PROCESS_START = time.perf_counter()  # utils.warmup is imported first thing by chat.py
+
+
+def _ms(since: float) -> float:
+    return round((time.perf_counter() - since) * 1000, 1)
+
+
+class _Task:
+    def __init__(self, fn: Callable):
+        self.fn = fn
+        self.claimed = False
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Warmup:
+    def __init__(self):
+        self._tasks: Dict[str, _Task] = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.timings: Dict[str, float] = {}   # phase -> ms
+
+    def add(self, name: str, fn: Callable):
+        """Register a task; re-registering a name (every Streamlit rerun does) is a no-op."""
+        with self._lock:
+            self._tasks.setdefault(name, _Task(fn))
+
+    def mark(self, phase: str):
+        """Record the time from process start to now, e.g. "login_rendered"."""
+        self.timings.setdefault(phase, _ms(PROCESS_START))
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+        self._thread.start()
+
+    def _claim(self, name: str):
+        with self._lock:
+            task = self._tasks[name]
+            if task.claimed:
+                return task, False
+            task.claimed = True
+            return task, True
+
+    def _execute(self, name: str, task: _Task):
+        started = time.perf_counter()
+        try:
+            task.value = task.fn()
+        except Exception as e:
+            task.error = e
+            print(f"[Warning] Warm-up task {name!r} failed: {e}")
+        finally:
+            self.timings[name] = _ms(started)
+            task.done.set()
+
+    def _run(self):
+        started = time.perf_counter()
+        for name in list(self._tasks):
+            task, mine = self._claim(name)
+            if mine:
+                self._execute(name, task)
+        self.timings["warmup_total"] = _ms(started)
+        self.mark("warm")
+        print("[Startup] " + ", ".join(f"{k} {v:.0f} ms" for k, v in self.timings.items()))
+
+    def result(self, name: str, timeout: float = None):
+        """The task's return value, waiting for the warm-up thread or running the task here."""
+        task, mine = self._claim(name)
+        if mine:
+            self._execute(name, task)
+        elif not task.done.wait(timeout):
+            raise TimeoutError(f"warm-up task {name!r} still running")
+        if task.error is not None and not mine:
+            # a failed background attempt (e.g. network not up yet) is retried once on the caller's thread
+            with self._lock:
+                task.error = None
+                task.done.clear()
+            self._execute(name, task)
+        if task.error is not None:
+            raise task.error
+        return task.value
+
+    def report(self) -> Dict[str, float]:
+        return dict(self.timings)
+
+
+WARMUP = Warmup()
+
+
+def timed_import(module: str):
+    """Import a module, recording how long the first import took as "import:<module>"."""
+    started = time.perf_counter()
+    mod = importlib.import_module(module)
+    WARMUP.timings.setdefault(f"import:{module}", _ms(started))
+    return mod